@@ -0,0 +1,422 @@
+"""Headless batch reduction with a file-based work queue.
+
+Jobs (one input_cmd.toml per field/night) are submitted into a queue directory
+on a shared filesystem. Any number of workers, on any machine that sees this
+directory, claim jobs one by one and run the reduction pipeline without GUI:
+
+    python batch.py submit ./queue ngc1234_night1.toml ngc1234_night2.toml
+    python batch.py work ./queue          (start as many as wanted, on any node)
+    python batch.py status ./queue
+
+Queue layout, all files of a job share its id:
+
+    <id>.toml       copy of the submitted configuration
+    <id>.json       job description (working directory of submit, relative paths are resolved against it)
+    <id>.lock       claim of a running job, created exclusively; its mtime is the heartbeat
+    <id>.attempts   one line per claim and per outcome
+    <id>.done       written after the results are complete
+
+A lock whose heartbeat is older than the stale timeout belongs to a crashed or
+disconnected worker and is taken over. Failed and stale attempts are retried
+until max_attempts claims have been made.
+"""
+
+import numpy as np
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import traceback
+from datetime import datetime
+from pathlib import Path
+from typing import NamedTuple
+
+import pipeline
+from catalogue_writer import CatalogueColumn, WRITERS
+from frame_index import FrameIndex
+
+
+# Defaults of the worker command line
+HEARTBEAT = 30.0        # seconds between touches of a held lock
+STALE_TIMEOUT = 300.0   # lock without heartbeat for this long is taken over
+MAX_ATTEMPTS = 3
+POLL_INTERVAL = 10.0    # seconds between looks into the queue while other jobs are running
+
+
+class Job(NamedTuple):
+    id: str
+    queue: Path
+
+    def file(self, suffix: str) -> Path:
+        return self.queue / f"{self.id}{suffix}"
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def list_jobs(queue: Path) -> list[Job]:
+    return [Job(config.stem, queue) for config in sorted(queue.glob("*.toml"))]
+
+
+def attempts(job: Job) -> list[dict]:
+    if not (path := job.file(".attempts")).exists():
+        return []
+    return [json.loads(line) for line in path.read_text().splitlines() if line]
+
+
+def record(job: Job, **entry):
+    """Appends one line to the attempt log. Short appends are atomic on local and NFS filesystems"""
+    entry = {"time": datetime.now().isoformat(timespec="seconds"), "worker": worker_name(), **entry}
+    with job.file(".attempts").open("a") as fl:
+        fl.write(json.dumps(entry) + "\n")
+
+
+def n_claims(job: Job) -> int:
+    return sum(1 for entry in attempts(job) if entry["event"] == "claimed")
+
+
+def submit(queue: Path, configs: list[Path]) -> list[Job]:
+    """Copies every configuration into the queue. Ids are made unique, so a config can be submitted again"""
+
+    queue.mkdir(parents=True, exist_ok=True)
+    jobs = []
+
+    for config in configs:
+        # fail before queueing anything a worker could not read
+        pipeline.load_config(config)
+
+        job_id = config.stem
+        n = 1
+        while True:
+            try:
+                # the description is created exclusively, it reserves the id
+                with open(Job(job_id, queue).file(".json"), "x") as fl:
+                    json.dump({"config": str(config.resolve()), "base_dir": str(Path.cwd()),
+                               "submitted": datetime.now().isoformat(timespec="seconds")}, fl)
+                break
+            except FileExistsError:
+                n += 1
+                job_id = f"{config.stem}_{n}"
+
+        # the .toml is what workers look for, so it is written last
+        tmp = queue / f".{job_id}.toml.tmp"
+        shutil.copyfile(config, tmp)
+        tmp.rename(Job(job_id, queue).file(".toml"))
+
+        jobs.append(Job(job_id, queue))
+
+    return jobs
+
+
+def lock_age(job: Job) -> float | None:
+    """Seconds since the last heartbeat, None if the job is not locked"""
+    try:
+        return time.time() - job.file(".lock").stat().st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def try_lock(job: Job, token: str) -> bool:
+    try:
+        fd = os.open(job.file(".lock"), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+
+    with os.fdopen(fd, "w") as fl:
+        fl.write(token)
+    return True
+
+
+def owns_lock(job: Job, token: str) -> bool:
+    try:
+        return job.file(".lock").read_text() == token
+    except FileNotFoundError:
+        return False
+
+
+def release(job: Job, token: str):
+    if owns_lock(job, token):
+        job.file(".lock").unlink(missing_ok=True)
+
+
+def break_stale_lock(job: Job, stale_timeout: float) -> bool:
+    """Removes the lock of a job whose worker stopped sending heartbeats.
+    The lock is renamed first, so of several workers finding the same stale lock only one removes it"""
+
+    stale = job.file(f".lock.stale.{os.getpid()}.{socket.gethostname()}")
+    try:
+        job.file(".lock").rename(stale)
+    except FileNotFoundError:
+        return False
+
+    # another worker may have replaced the stale lock by a fresh one in between, give that one back
+    if time.time() - stale.stat().st_mtime < stale_timeout:
+        try:
+            os.link(stale, job.file(".lock"))
+        except FileExistsError:
+            pass
+        stale.unlink()
+        return False
+
+    owner = stale.read_text()
+    stale.unlink()
+    record(job, event="stale", owner=owner)
+    return True
+
+
+def claim(queue: Path, token: str, max_attempts: int, stale_timeout: float) -> Job | None:
+    """Locks the first job which is neither done nor out of attempts"""
+
+    for job in list_jobs(queue):
+        if job.file(".done").exists():
+            continue
+
+        age = lock_age(job)
+        if age is not None:
+            if age < stale_timeout or not break_stale_lock(job, stale_timeout):
+                continue
+
+        # a stale lock was the last attempt of the job as well
+        if n_claims(job) >= max_attempts:
+            continue
+
+        if try_lock(job, token):
+            # done may have been written between the check above and locking
+            if job.file(".done").exists():
+                release(job, token)
+                continue
+
+            record(job, event="claimed")
+            return job
+
+    return None
+
+
+def is_active(queue: Path, max_attempts: int) -> bool:
+    """True while any job is running or may still be retried"""
+    return any(not job.file(".done").exists() and (n_claims(job) < max_attempts or lock_age(job) is not None)
+               for job in list_jobs(queue))
+
+
+class Heartbeat(threading.Thread):
+    """Touches the lock of the running job, so other workers see it is still alive"""
+
+    def __init__(self, job: Job, token: str, interval: float):
+        super().__init__(daemon=True)
+
+        self.job = job
+        self.token = token
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lost = False
+
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if not owns_lock(self.job, self.token):
+                    raise FileNotFoundError
+                os.utime(self.job.file(".lock"))
+            except FileNotFoundError:
+                # lock was taken over, the job will be run elsewhere
+                self.lost = True
+                return
+
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def instrumental_catalogue(band_names: tuple[str, ...], positions: np.ndarray, flux: np.ndarray, detected: np.ndarray) -> list[CatalogueColumn]:
+    """Positions, fluxes and instrumental magnitudes of all stars. Calibration needs labeled stars, which is done in the GUI"""
+
+    columns = [CatalogueColumn("ID", np.arange(positions.shape[1]), "%03d")]
+
+    for i, band in enumerate(band_names):
+        columns.append(CatalogueColumn(f"x_{band}", positions[i, :, 0], "%7.2f", "pix"))
+        columns.append(CatalogueColumn(f"y_{band}", positions[i, :, 1], "%7.2f", "pix"))
+
+    for i, band in enumerate(band_names):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mag = np.where(flux[i] > 0, -2.5 * np.log10(flux[i]), np.nan)
+
+        columns.append(CatalogueColumn(f"flux_{band}", flux[i], "%10.4f", "adu"))
+        columns.append(CatalogueColumn(f"{band}_inst", mag, "%8.4f", "mag"))
+        columns.append(CatalogueColumn(f"detected_{band}", detected[i].astype(np.uint8), "%d"))
+
+    return columns
+
+
+def run_job(job: Job, path_index: Path | None = None) -> dict:
+    """Reduces all bands of the job, writes masters, catalogue and timing into path_result/<job id>/.
+    Returns the timing summary"""
+
+    description = json.loads(job.file(".json").read_text())
+    input_cmd = pipeline.load_config(job.file(".toml"))
+
+    # like in the GUI, relative paths are relative to the working directory, the one submit was called in
+    os.chdir(description["base_dir"])
+
+    timing = {}
+    start = time.perf_counter()
+
+    def stage(name: str):
+        timing[name] = round(time.perf_counter() - start - sum(timing.values()), 3)
+
+    frame_index = FrameIndex(path_index or input_cmd["path_index"])
+    bands = pipeline.bands_from_config(input_cmd)
+    band_names = tuple(band.name for band in bands)
+
+    try:
+        pipeline.scan_directories(bands, input_cmd, frame_index)
+        band_frames = [pipeline.select_frames(band, input_cmd, frame_index) for band in bands]
+    finally:
+        frame_index.close()
+    stage("index")
+
+    for frames in band_frames:
+        if not frames.lights:
+            raise FileNotFoundError(f"Could not find {frames.band.name} files at {frames.band.path_light}")
+
+    results = pipeline.reduce_bands(band_frames, input_cmd)
+    masters = np.array([result.master for result in results])
+    stage("reduction")
+
+    offset, median, std = pipeline.align_masters(masters)
+    n_stars, positions, flux, detected = pipeline.measure_stars(masters, median, std, input_cmd)
+    stage("photometry")
+
+    path_save = Path(input_cmd["path_result"]) / job.id
+    written = pipeline.save_masters(results, masters, path_save)
+
+    base_path = path_save / f"instrumental_{'-'.join(band_names)}"
+    columns = instrumental_catalogue(band_names, positions, flux, detected)
+    for fmt in input_cmd["export_formats"]:
+        WRITERS[fmt](base_path.with_suffix(f".{fmt}"), columns)
+        written.append(base_path.with_suffix(f".{fmt}"))
+    stage("output")
+
+    summary = {
+        "job": job.id,
+        "worker": worker_name(),
+        "n_stars": n_stars,
+        "lights": {result.band.name: [fit_name.name for fit_name in result.lights] for result in results},
+        "master_offset": offset.tolist(),
+        "warnings": [warning for result in results for warning in result.warnings],
+        "log": [line for result in results for line in result.log],
+        "files": [str(path) for path in written],
+        "timing": {**timing, "total": round(time.perf_counter() - start, 3)},
+    }
+    (path_save / "timing.json").write_text(json.dumps(summary, indent=2))
+
+    return summary
+
+
+def work(queue: Path, max_attempts: int, stale_timeout: float, heartbeat: float, poll_interval: float,
+         path_index: Path | None = None, once: bool = False):
+    """Runs jobs until none is left. While other workers still hold locks, the queue is polled,
+    their jobs may fail or go stale and need a retry"""
+
+    cwd = Path.cwd()
+    token = f"{worker_name()}:{time.time_ns()}"
+
+    while True:
+        job = claim(queue, token, max_attempts, stale_timeout)
+
+        if job is None:
+            if once or not is_active(queue, max_attempts):
+                return
+            time.sleep(poll_interval)
+            continue
+
+        print(f"{job.id}: started by {worker_name()}")
+        beat = Heartbeat(job, token, heartbeat)
+        beat.start()
+
+        try:
+            summary = run_job(job, path_index)
+        # detect_star quits via exit() if too few stars are found
+        except (Exception, SystemExit) as e:
+            beat.stop()
+            record(job, event="failed", error=f"{type(e).__name__}: {e}", traceback=traceback.format_exc())
+            print(f"{job.id}: failed ({type(e).__name__}: {e})")
+        else:
+            beat.stop()
+            if beat.lost or not owns_lock(job, token):
+                # results were written, but the job was handed to another worker meanwhile
+                record(job, event="lost lock")
+                print(f"{job.id}: lock was taken over, not marked as done")
+            else:
+                job.file(".done").write_text(json.dumps(summary["timing"]))
+                record(job, event="done", timing=summary["timing"])
+                print(f"{job.id}: done in {summary['timing']['total']:.1f} s")
+        finally:
+            release(job, token)
+            os.chdir(cwd)
+            token = f"{worker_name()}:{time.time_ns()}"
+
+
+def status(queue: Path, max_attempts: int, stale_timeout: float):
+    for job in list_jobs(queue):
+        age = lock_age(job)
+        claims = n_claims(job)
+
+        if job.file(".done").exists():
+            state = "done"
+        elif age is not None:
+            state = "running" if age < stale_timeout else "stale"
+        elif claims >= max_attempts:
+            state = "failed"
+        else:
+            state = "pending"
+
+        last = next((entry for entry in reversed(attempts(job)) if entry["event"] != "claimed"), None)
+        info = f"{last['event']} on {last['worker']}" + (f": {last['error']}" if "error" in last else "") if last else ""
+
+        print(f"{job.id:30s} {state:8s} {claims}/{max_attempts}  {info}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distributed batch reduction via a shared queue directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    submit_parser = commands.add_parser("submit", help="add configurations (input_cmd.toml files) as jobs")
+    submit_parser.add_argument("queue", type=Path)
+    submit_parser.add_argument("configs", type=Path, nargs="+")
+
+    for name, help_text in (("work", "run jobs until the queue is finished"), ("status", "show state of all jobs")):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument("queue", type=Path)
+        command.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS)
+        command.add_argument("--stale-timeout", type=float, default=STALE_TIMEOUT)
+
+        if name == "work":
+            command.add_argument("--heartbeat", type=float, default=HEARTBEAT)
+            command.add_argument("--poll-interval", type=float, default=POLL_INTERVAL)
+            command.add_argument("--index", type=Path, default=None,
+                                 help="frame index to use instead of path_index, e.g. a local file if the queue is on NFS")
+            command.add_argument("--once", action="store_true", help="stop as soon as no job can be claimed")
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "submit":
+            for job in submit(args.queue, args.configs):
+                print(f"Submitted {job.id}")
+        case "work":
+            if args.heartbeat >= args.stale_timeout:
+                parser.error("heartbeat has to be shorter than stale timeout")
+            work(args.queue.resolve(), args.max_attempts, args.stale_timeout, args.heartbeat, args.poll_interval,
+                 args.index and args.index.resolve(), args.once)
+        case "status":
+            status(args.queue, args.max_attempts, args.stale_timeout)
+
+
+if __name__ == "__main__":
+    main()
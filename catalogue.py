@@ -0,0 +1,130 @@
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
+from scipy.spatial import cKDTree
+
+from contextlib import contextmanager
+from pathlib import Path
+
+
+def _read_cache(path_cache: Path, columns: list[str]) -> np.ndarray | None:
+    """The cache holds exactly the configured columns, a cache of other columns is not used"""
+
+    data = np.load(path_cache, mmap_mode="r")
+    return data if data.dtype.names == tuple(columns) else None
+
+
+@contextmanager
+def load_catalogue(path_catalogue: Path | str, columns: list[str]):
+    """Yields the given columns of a reference catalogue as memory-mapped arrays, the file is closed on exit.
+    FITS tables are mapped directly, CSV files are converted once into a .npy cache beside them"""
+
+    path_catalogue = Path(path_catalogue)
+
+    if path_catalogue.suffix.lower() in (".fit", ".fits", ".fts"):
+        # Table HDUs are memory-mapped by astropy, only touched pages are read
+        with fits.open(path_catalogue, memmap=True) as hdul:
+            data = hdul[1].data
+            yield {name: data[name] for name in columns}
+        return
+
+    path_cache = path_catalogue.with_suffix(path_catalogue.suffix + ".npy")
+
+    data = None
+    if path_cache.exists() and path_cache.stat().st_mtime >= path_catalogue.stat().st_mtime:
+        data = _read_cache(path_cache, columns)
+
+    if data is None:
+        table = Table.read(path_catalogue, format="ascii.csv", include_names=columns, fast_reader=True)
+
+        # fields are filled by name, the order of columns in the file may differ from columns;
+        # empty cells are masked by astropy and become NaN
+        array = np.empty(len(table), dtype=[(name, np.float64) for name in columns])
+        for name in columns:
+            array[name] = np.ma.filled(np.ma.asarray(table[name], dtype=np.float64), np.nan)
+
+        np.save(path_cache, array)
+        data = np.load(path_cache, mmap_mode="r")
+
+    yield {name: data[name] for name in columns}
+
+
+def anchor_transform(anchors: list[list[float]]):
+    """Least squares affine transformation from catalogue coordinates to pixel positions.
+    Each anchor is [x_px, y_px, cat_x, cat_y], at least three anchors are needed"""
+
+    anchors = np.asarray(anchors, dtype=np.float64)
+    if anchors.ndim != 2 or anchors.shape[0] < 3:
+        raise ValueError("At least three catalogue anchors [x_px, y_px, cat_x, cat_y] are needed")
+
+    design = np.c_[anchors[:, 2:4], np.ones(len(anchors))]
+    matrix, *_ = np.linalg.lstsq(design, anchors[:, 0:2], rcond=None)
+
+    return lambda cat_x, cat_y: np.c_[cat_x, cat_y, np.ones(len(cat_x))] @ matrix
+
+
+def footprint_mask(wcs: WCS, pixel, ra: np.ndarray, dec: np.ndarray, margin: float = 0.05) -> np.ndarray:
+    """Cheap RA/Dec box cut to the frame footprint, so only a few rows have to be projected by the WCS"""
+
+    corners = np.array([[0, 0], [pixel[1], 0], [0, pixel[0]], [pixel[1], pixel[0]]], dtype=np.float64)
+    corner_ra, corner_dec = wcs.all_pix2world(corners[:, 0], corners[:, 1], 0)
+
+    ra_center = corner_ra[0]
+    # Measure RA relative to one corner to survive the 0/360 degree wrap
+    corner_dra = (corner_ra - ra_center + 180.) % 360. - 180.
+    dra = (ra - ra_center + 180.) % 360. - 180.
+
+    span_ra = np.ptp(corner_dra)
+    span_dec = np.ptp(corner_dec)
+
+    return ((dra >= corner_dra.min() - margin * span_ra) & (dra <= corner_dra.max() + margin * span_ra) &
+            (dec >= corner_dec.min() - margin * span_dec) & (dec <= corner_dec.max() + margin * span_dec))
+
+
+def project_catalogue(catalogue: dict[str, np.ndarray], columns: list[str], pixel,
+                      header: fits.Header | None = None, anchors: list[list[float]] | None = None
+                      ) -> tuple[np.ndarray, np.ndarray]:
+    """Projects the catalogue into the reference frame. Uses the frame WCS if header has one,
+    the anchor matches otherwise. Returns pixel positions and row indices of all rows inside the frame"""
+
+    cat_x = catalogue[columns[0]]
+    cat_y = catalogue[columns[1]]
+
+    wcs = WCS(header) if header is not None else None
+
+    if wcs is not None and wcs.has_celestial:
+        rows = np.flatnonzero(footprint_mask(wcs.celestial, pixel, cat_x, cat_y))
+        px, py = wcs.celestial.all_world2pix(cat_x[rows], cat_y[rows], 0)
+        xy = np.c_[px, py]
+    elif anchors:
+        rows = np.arange(len(cat_x))
+        xy = anchor_transform(anchors)(cat_x, cat_y)
+    else:
+        raise ValueError("Frame has no celestial WCS and no catalogue anchors are given")
+
+    inside = (xy[:, 0] >= 0) & (xy[:, 0] < pixel[1]) & (xy[:, 1] >= 0) & (xy[:, 1] < pixel[0])
+    return xy[inside], rows[inside]
+
+
+def cross_match(positions: np.ndarray, cat_xy: np.ndarray, radius: float) -> tuple[np.ndarray, np.ndarray]:
+    """Matches every catalogue position to the nearest detected star within radius (pixels).
+    If several catalogue entries hit the same star, the closest one is kept.
+    Returns matched star indices and corresponding catalogue indices"""
+
+    if len(positions) == 0 or len(cat_xy) == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+    tree = cKDTree(positions)
+    distance, star_idx = tree.query(cat_xy, k=1, distance_upper_bound=radius)
+
+    # Misses are reported with infinite distance
+    cat_idx = np.flatnonzero(np.isfinite(distance))
+    star_idx = star_idx[cat_idx]
+    distance = distance[cat_idx]
+
+    # Sort by distance, np.unique then returns the first (closest) hit per star
+    order = np.argsort(distance, kind="stable")
+    star_idx, first = np.unique(star_idx[order], return_index=True)
+
+    return star_idx, cat_idx[order][first]
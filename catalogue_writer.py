@@ -0,0 +1,128 @@
+from PySide6.QtCore import QObject, QRunnable, Signal
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+
+import io
+from pathlib import Path
+from typing import NamedTuple
+
+
+class CatalogueColumn(NamedTuple):
+    name: str
+    data: np.ndarray
+    fmt: str            # printf-style format for text output
+    unit: str = ""
+
+
+# Rows are written in chunks of this size, so memory stays bounded for large catalogues
+CHUNK_SIZE = 100_000
+
+
+def _chunks(columns: list[CatalogueColumn], chunk_size: int):
+    n_rows = len(columns[0].data)
+    for start in range(0, n_rows, chunk_size):
+        yield [column.data[start:start + chunk_size] for column in columns]
+
+
+def _write_rows(fl, columns: list[CatalogueColumn], delimiter: str, chunk_size: int):
+    """Formats whole chunks with one format string per row instead of one f-string per value"""
+
+    fmt = [column.fmt for column in columns]
+    for chunk in _chunks(columns, chunk_size):
+        np.savetxt(fl, np.column_stack(chunk), fmt=fmt, delimiter=delimiter)
+
+
+def write_text(path: Path, columns: list[CatalogueColumn], chunk_size: int = CHUNK_SIZE):
+    """Tab separated text, header line starting with '#'"""
+
+    with path.open("w") as fl:
+        fl.write("#" + "\t".join(f"{c.name}[{c.unit}]" if c.unit else c.name for c in columns) + "\n")
+        _write_rows(fl, columns, "\t", chunk_size)
+
+
+def write_ecsv(path: Path, columns: list[CatalogueColumn], chunk_size: int = CHUNK_SIZE):
+    """Astropy ECSV: typed header (with units) from astropy, rows streamed below it"""
+
+    header = io.StringIO()
+    Table([np.empty(0, dtype=c.data.dtype) for c in columns],
+          names=[c.name for c in columns],
+          units=[c.unit or None for c in columns]).write(header, format="ascii.ecsv")
+
+    with path.open("w") as fl:
+        fl.write(header.getvalue())
+        _write_rows(fl, columns, " ", chunk_size)
+
+
+def _fits_type(dtype: np.dtype) -> tuple[str, str]:
+    """FITS binary table column format and matching big-endian numpy type"""
+    if dtype.kind == "f":
+        return "D", ">f8"
+    if dtype == np.uint8:
+        return "B", "u1"
+    return "K", ">i8"
+
+
+def write_fits(path: Path, columns: list[CatalogueColumn], chunk_size: int = CHUNK_SIZE):
+    """FITS binary table. The header is written first, then rows are appended as raw big-endian records"""
+
+    fits_columns = [fits.Column(name=c.name, format=_fits_type(c.data.dtype)[0], unit=c.unit or None)
+                    for c in columns]
+    record = np.dtype([(c.name, _fits_type(c.data.dtype)[1]) for c in columns])
+
+    table_hdu = fits.BinTableHDU.from_columns(fits_columns, nrows=0)
+    table_hdu.header["NAXIS2"] = len(columns[0].data)
+
+    with path.open("wb") as fl:
+        fl.write(fits.PrimaryHDU().header.tostring().encode("ascii"))
+        fl.write(table_hdu.header.tostring().encode("ascii"))
+
+        for chunk in _chunks(columns, chunk_size):
+            rows = np.empty(len(chunk[0]), dtype=record)
+            for column, data in zip(columns, chunk):
+                rows[column.name] = data
+            fl.write(rows.tobytes())
+
+        # data part has to fill complete 2880 byte blocks
+        fl.write(bytes(-fl.tell() % 2880))
+
+
+WRITERS = {
+    "dat": write_text,
+    "ecsv": write_ecsv,
+    "fits": write_fits,
+}
+
+
+class CatalogueWriterSignals(QObject):
+    # Emitted with the writer and the written files, or with the writer and an error message
+    finished = Signal(object, list)
+    failed = Signal(object, str)
+
+
+class CatalogueWriter(QRunnable):
+    """Writes one catalogue in all given formats off the GUI thread.
+    Columns have to be copies, the GUI may change the originals while writing"""
+
+    def __init__(self, base_path: Path, columns: list[CatalogueColumn], formats: list[str]):
+        super().__init__()
+
+        self.base_path = base_path
+        self.columns = columns
+        self.formats = formats
+        self.signals = CatalogueWriterSignals()
+
+
+    def run(self):
+        written = []
+        try:
+            for fmt in self.formats:
+                path = self.base_path.with_suffix(f".{fmt}")
+                WRITERS[fmt](path, self.columns)
+                written.append(str(path))
+        # anything raised here would end silently in the pool thread, the GUI has to hear about it
+        except Exception as e:
+            self.signals.failed.emit(self, f"{type(e).__name__}: {e}")
+        else:
+            self.signals.finished.emit(self, written)
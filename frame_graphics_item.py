@@ -0,0 +1,100 @@
+from PySide6.QtWidgets import QGraphicsItem
+from PySide6.QtGui import QImage, QPainter
+from PySide6.QtCore import QRectF
+
+import numpy as np
+
+
+class FrameGraphicsItem(QGraphicsItem):
+    """Displays one of several equally sized frames as 8 bit grayscale image.
+    The QImage is a view on self.buffer, so changing levels or frames only rewrites
+    the buffer in place and repaints, no image or pixmap is copied"""
+
+    Stretches = ("log", "asinh", "sqrt", "linear")
+
+    # Every n-th pixel is used to look up percentiles, sorting the full frame would be too slow
+    n_samples = 2 ** 18
+
+
+    def __init__(self, frames: np.ndarray, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Needed for option.exposedRect in paint
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+
+        self.frames = np.asarray(frames, dtype=np.float32)
+        height, width = self.frames.shape[1:]
+
+        step = max(1, height * width // self.n_samples)
+        self.samples = np.sort(self.frames.reshape(len(self.frames), -1)[:, ::step], axis=1)
+
+        self.scratch = np.empty((height, width), dtype=np.float32)
+        self.buffer = np.zeros((height, width), dtype=np.uint8)
+        self.image = QImage(self.buffer.data, width, height, width, QImage.Format.Format_Grayscale8)
+
+        self.current = 0
+        self.black = 50.0
+        self.white = 99.9
+        self.stretch = self.Stretches[0]
+
+        self.render()
+
+
+    def boundingRect(self) -> QRectF:
+        return QRectF(0, 0, self.image.width(), self.image.height())
+
+
+    def paint(self, painter: QPainter, option, widget=None):
+        # Only draw the exposed part, zoomed in views of large frames stay cheap
+        rect = option.exposedRect
+        painter.drawImage(rect, self.image, rect)
+
+
+    def percentile(self, percent: float) -> float:
+        samples = self.samples[self.current]
+        return float(samples[min(len(samples) - 1, int(percent / 100 * len(samples)))])
+
+
+    def set_levels(self, black: float, white: float, stretch: str):
+        """Black and white point as percentiles of the current frame"""
+
+        self.black, self.white, self.stretch = black, white, stretch
+        self.render()
+
+
+    def show_frame(self, index: int):
+        self.current = index
+        self.render()
+
+
+    def render(self):
+        """Rewrites the display buffer from the current frame, levels and stretch"""
+
+        black = self.percentile(self.black)
+        white = max(self.percentile(self.white), black + 1e-6)
+        s = self.scratch
+
+        # normalize to [0, 1] in place
+        np.subtract(self.frames[self.current], black, out=s)
+        np.multiply(s, 1 / (white - black), out=s)
+        np.clip(s, 0, 1, out=s)
+
+        match self.stretch:
+            case "log":
+                # same scaling as util.hist_log
+                np.multiply(s, 1000, out=s)
+                np.log1p(s, out=s)
+                np.multiply(s, 1 / np.log(1001), out=s)
+            case "asinh":
+                np.multiply(s, 10, out=s)
+                np.arcsinh(s, out=s)
+                np.multiply(s, 1 / np.arcsinh(10), out=s)
+            case "sqrt":
+                np.sqrt(s, out=s)
+            case _:
+                pass
+
+        np.multiply(s, 255, out=s)
+        np.copyto(self.buffer, s, casting="unsafe")
+
+        self.update()
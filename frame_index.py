@@ -0,0 +1,152 @@
+from astropy.io import fits
+
+import sqlite3
+from pathlib import Path
+
+import util
+
+
+class FrameIndex:
+    """Persistent SQLite index of FITS files and their header metadata.
+    Directories are scanned incrementally: a file's header is only read again
+    if its mtime or size changed since the last scan"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS frames (
+        path      TEXT PRIMARY KEY,
+        directory TEXT NOT NULL,
+        mtime     REAL NOT NULL,
+        size      INTEGER NOT NULL,
+        naxis1    INTEGER,
+        naxis2    INTEGER,
+        filter    TEXT,
+        exptime   REAL,
+        date_obs  TEXT,
+        imagetyp  TEXT
+    );
+    CREATE INDEX IF NOT EXISTS frames_directory ON frames (directory);
+    """
+
+    # Header keywords differ between camera drivers, first match wins
+    EXPTIME_KEYS = ("EXPTIME", "EXPOSURE")
+    DATE_KEYS = ("DATE-OBS", "DATE")
+
+    # Tolerance for comparing exposure times read from different headers
+    EXPTIME_TOLERANCE = 1e-3
+
+
+    def __init__(self, db_path: Path | str):
+        db_path = Path(db_path)
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.connection = sqlite3.connect(db_path)
+        self.connection.executescript(self.SCHEMA)
+
+
+    def close(self):
+        self.connection.close()
+
+
+    @staticmethod
+    def _directory_key(directory: Path | str) -> str:
+        return str(Path(directory).resolve())
+
+
+    @classmethod
+    def _read_header(cls, fit_name: Path) -> tuple:
+        """Reads only the primary header, pixel data is never loaded"""
+
+        header = fits.getheader(fit_name, 0)
+
+        exptime = next((header[k] for k in cls.EXPTIME_KEYS if k in header), None)
+        date_obs = next((header[k] for k in cls.DATE_KEYS if k in header), None)
+
+        return (header.get("NAXIS1"), header.get("NAXIS2"), header.get("FILTER"),
+                None if exptime is None else float(exptime), date_obs, header.get("IMAGETYP"))
+
+
+    def scan(self, directory: Path | str) -> int:
+        """Brings the index of directory up to date, returns the number of (re-)read files"""
+
+        dir_key = self._directory_key(directory)
+        known = {
+            path: (mtime, size)
+            for path, mtime, size in self.connection.execute(
+                "SELECT path, mtime, size FROM frames WHERE directory = ?", (dir_key,))
+        }
+
+        updated = []
+        for fit_name in util.get_fits_names(directory):
+            path = str(fit_name.resolve())
+            stat = fit_name.stat()
+
+            if known.pop(path, None) == (stat.st_mtime, stat.st_size):
+                continue
+
+            updated.append((path, dir_key, stat.st_mtime, stat.st_size, *self._read_header(fit_name)))
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", updated)
+
+            # Everything still left in known has been removed from disk
+            self.connection.executemany(
+                "DELETE FROM frames WHERE path = ?", ((path,) for path in known))
+
+        return len(updated)
+
+
+    def select(self, directory: Path | str | None = None, exptime: float | None = None,
+               date_from: str | None = None, date_to: str | None = None,
+               filter_name: str | None = None) -> list[Path]:
+        """Returns the sorted file names matching all given criteria. Criteria set to None are ignored.
+        Frames without exposure time in their header match any exptime, they are not dropped silently.
+        Dates are compared as ISO-8601 strings, date_to is inclusive"""
+
+        clauses, params = [], []
+
+        if directory is not None:
+            clauses.append("directory = ?")
+            params.append(self._directory_key(directory))
+
+        if exptime is not None:
+            clauses.append("(exptime IS NULL OR ABS(exptime - ?) <= ?)")
+            params.extend((exptime, self.EXPTIME_TOLERANCE))
+
+        if date_from:
+            clauses.append("date_obs >= ?")
+            params.append(date_from)
+
+        if date_to:
+            # Full timestamps on the last day compare greater than the bare date
+            clauses.append("substr(date_obs, 1, length(?)) <= ?")
+            params.extend((date_to, date_to))
+
+        if filter_name is not None:
+            clauses.append("filter = ?")
+            params.append(filter_name)
+
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+        return [Path(path) for path, in self.connection.execute(
+            f"SELECT path FROM frames {where} ORDER BY path", params)]
+
+
+    def without_exptime(self, fit_list: list[Path]) -> list[Path]:
+        """Returns the given (indexed) files whose header has no exposure time"""
+
+        return [Path(path) for path, in self.connection.execute(
+            f"SELECT path FROM frames WHERE exptime IS NULL AND path IN ({', '.join('?' * len(fit_list))}) ORDER BY path",
+            [str(Path(fit_name).resolve()) for fit_name in fit_list])]
+
+
+    def exptimes(self, fit_list: list[Path]) -> set[float]:
+        """Returns the distinct exposure times of the given (indexed) files"""
+
+        return {
+            exptime
+            for exptime, in self.connection.execute(
+                f"SELECT DISTINCT exptime FROM frames WHERE path IN ({', '.join('?' * len(fit_list))})",
+                [str(Path(fit_name).resolve()) for fit_name in fit_list])
+            if exptime is not None
+        }
@@ -1,20 +1,20 @@
-from PySide6.QtWidgets import QWidget, QHBoxLayout, QVBoxLayout, QPushButton, QGraphicsScene, QInputDialog, QMessageBox, QDoubleSpinBox, QLabel
-from PySide6.QtCore import QRect, QPoint, Slot
+from PySide6.QtWidgets import QWidget, QHBoxLayout, QVBoxLayout, QPushButton, QGraphicsScene, QInputDialog, QMessageBox, QDoubleSpinBox, QLabel, QFileDialog, QComboBox
+from PySide6.QtCore import Slot, QThreadPool
 import numpy as np
 from astropy.io import fits
-from photutils.aperture import CircularAperture, aperture_photometry
 
-import util
+import catalogue
+import pipeline
 
-import tomllib
 from pathlib import Path
 from datetime import datetime
 
-from PIL import Image
-
-from star_ellipse import StarEllipse, StarStatus
+from star_field import StarField, StarStatus
 from star_graphics_view import StarGraphicsView
 from plot_window import PlotWindow
+from frame_index import FrameIndex
+from frame_graphics_item import FrameGraphicsItem
+from catalogue_writer import CatalogueColumn, CatalogueWriter
 
 
 class MainWindow(QWidget):
@@ -22,36 +22,31 @@ class MainWindow(QWidget):
     # TODO: dump log if wanted
 
 
-    @staticmethod
-    def shift_data(data, n_len, offset, pixel):
-        """Extracted from old script, as this code block was used multiple times"""
-
-        for i in range(n_len):
-            upper0 = abs(max(0, offset[i, 0]))
-            lower0 = abs(min(0, offset[i, 0]))
-            upper1 = abs(max(0, offset[i, 1]))
-            lower1 = abs(min(0, offset[i, 1]))
-            tmp = np.pad(data[i], ((upper0, lower0), (upper1, lower1)), mode='constant')
-            data[i] = tmp[lower0 : pixel[0] + lower0,
-                          lower1 : pixel[1] + lower1]
-
-
     def __init__(self):
         """Setup Gui and calls self.setup()"""
 
         super().__init__()
 
-        self.plot_windows = set()
+        # Plot windows are created once per plot and reused afterwards
+        self.plot_windows: dict[str, PlotWindow] = {}
+        # Running catalogue writers, referenced until they report back
+        self.catalogue_writers = set()
         self.logger = [f"Started program @ {datetime.now().strftime('%Y-%m-%dT%H-%M-%S')}"]
 
-        with open("input_cmd.toml", "rb") as fl:
-            self.input_cmd = tomllib.load(fl)
+        self.input_cmd = pipeline.load_config("input_cmd.toml")
+
+        self.frame_index = FrameIndex(self.input_cmd["path_index"])
+
+        self.bands = pipeline.bands_from_config(self.input_cmd)
+        self.band_names = tuple(band.name for band in self.bands)
 
         # Setup Graphics View
 
         self.scene = QGraphicsScene()
         self.graphics_view = StarGraphicsView(self.scene)
         self.graphics_view.star_chosen.connect(self.info_star)
+        self.frame_item = None
+        self.star_field = None
 
         # Setup UI
 
@@ -59,25 +54,52 @@ class MainWindow(QWidget):
 
         reddening_label = QLabel("Reddening")
         self.reddening_box = QDoubleSpinBox(value=0.0)
+        self.reddening_box.valueChanged.connect(self.reddening_changed)
         button_stack.addWidget(reddening_label)
         button_stack.addWidget(self.reddening_box)
 
+        # Display levels, applied to the frame shown in the graphics view
+
+        black_label = QLabel("Black Point [%]")
+        self.black_box = QDoubleSpinBox(minimum=0.0, maximum=100.0, singleStep=0.5, value=50.0)
+        self.black_box.valueChanged.connect(self.levels_changed)
+        button_stack.addWidget(black_label)
+        button_stack.addWidget(self.black_box)
+
+        white_label = QLabel("White Point [%]")
+        self.white_box = QDoubleSpinBox(minimum=0.0, maximum=100.0, singleStep=0.1, value=99.9)
+        self.white_box.valueChanged.connect(self.levels_changed)
+        button_stack.addWidget(white_label)
+        button_stack.addWidget(self.white_box)
+
+        stretch_label = QLabel("Stretch")
+        self.stretch_box = QComboBox()
+        self.stretch_box.addItems(FrameGraphicsItem.Stretches)
+        self.stretch_box.currentTextChanged.connect(self.levels_changed)
+        button_stack.addWidget(stretch_label)
+        button_stack.addWidget(self.stretch_box)
+
+        self.button_blink = QPushButton(f"Blink ({self.band_names[0]})")
+        self.button_blink.clicked.connect(self.button_blink_clicked)
+        button_stack.addWidget(self.button_blink)
+
         button_offset_master = QPushButton("Masters Offset")
         button_offset_master.clicked.connect(self.button_offset_master_clicked)
         button_stack.addWidget(button_offset_master)
 
-        button_offset_short = QPushButton(f"Plot {self.input_cmd['short_colour']} Offset")
-        button_offset_short.clicked.connect(self.button_offset_short_clicked)
-        button_stack.addWidget(button_offset_short)
-
-        button_offset_long = QPushButton(f"Plot {self.input_cmd['long_colour']} Offset")
-        button_offset_long.clicked.connect(self.button_offset_long_clicked)
-        button_stack.addWidget(button_offset_long)
+        for i, name in enumerate(self.band_names):
+            button_offset_band = QPushButton(f"Plot {name} Offset")
+            button_offset_band.clicked.connect(lambda _=False, i=i: self.button_offset_band_clicked(i))
+            button_stack.addWidget(button_offset_band)
 
         button_toggle_selection = QPushButton("Toggle Selection")
         button_toggle_selection.clicked.connect(self.button_toggle_selection_clicked)
         button_stack.addWidget(button_toggle_selection)
 
+        button_catalogue = QPushButton("Load Catalogue")
+        button_catalogue.clicked.connect(self.button_catalogue_clicked)
+        button_stack.addWidget(button_catalogue)
+
         button_preview = QPushButton("FHD Diagram")
         button_preview.clicked.connect(self.button_preview_clicked)
         button_stack.addWidget(button_preview)
@@ -91,185 +113,84 @@ class MainWindow(QWidget):
         self.setup()
 
 
-    def create_plot_window(self) -> PlotWindow:
-        plot_win = PlotWindow()
-        plot_win.closed.connect(self.plot_window_closed)
-
-        self.plot_windows.add(plot_win)
-        return plot_win
-
-
-    def dark_correction(self, scidata: np.ndarray, n_short_light: int):
-        if lst := util.get_fits_names(self.input_cmd["path_dark_short"]):
-            frames = util.fits_to_array(lst)
-            scidata[:n_short_light] = util.dark_correction(scidata[:n_short_light], frames)
-        else:
-            QMessageBox.warning(self,
-                "File not found",
-                "Could not find files for short wave dark correction")
-
-        if lst := util.get_fits_names(self.input_cmd["path_dark_long"]):
-            frames = util.fits_to_array(lst)
-            scidata[n_short_light:] = util.dark_correction(scidata[n_short_light:], frames)
-        else:
-            QMessageBox.warning(self,
-                "File not found",
-                "Could not find files for long wave dark correction")
-
-
-    def flat_fielding(self, scidata: np.ndarray, n_short_light: int):
-        # Define identity lambda if not dark correction can/should be used for flats
-        dark_correct_flats = lambda x: x
-
-        # Define dark_correct_flats otherwise
-        if self.input_cmd["do_dark_flat"]:
-            if lst := util.get_fits_names(self.input_cmd["path_dark_flat"]):
-                flat_darks = util.fits_to_array(lst)
-                dark_correct_flats = lambda x: util.dark_correction(x, flat_darks)
-            else:
-                QMessageBox.warning(self,
-                    "File not found",
-                    "Could not find files for dark correction of flats")
-
-        # Flatfielding starts here
-        if lst := util.get_fits_names(self.input_cmd["path_flat_short"]):
-            frames = dark_correct_flats(util.fits_to_array(lst))
-            scidata[:n_short_light] = util.flat_correction(scidata[:n_short_light], frames)
-        else:
-            QMessageBox.warning(self,
-                "File not found",
-                "Could not find files for short wave flatfielding")
+    def show_plot_window(self, name: str, plot) -> PlotWindow:
+        """Shows the plot window called name. It is only created and plotted (plot(plot_win)) on first use"""
 
-        if lst := util.get_fits_names(self.input_cmd["path_flat_long"]):
-            frames = dark_correct_flats(util.fits_to_array(lst))
-            scidata[n_short_light:] = util.flat_correction(scidata[n_short_light:], frames)
-        else:
-            QMessageBox.warning(self,
-                "Files not found",
-                "Could not find files for long wave flatfielding")
-
-
-    def master_wave(self, data: np.ndarray, n_light: int, pixel) -> tuple[np.ndarray, np.ndarray]:
-        if n_light > 1:
-            _, median, std = util.get_stats(data)
-            wave_offset = util.get_offset(data, median, std, 0)
-            self.shift_data(data, n_light, wave_offset, pixel)
-            master_wave = util.create_master(data)
-        else:
-            wave_offset = np.zeros((n_light, 2), dtype=int)
-            master_wave = data
+        if (plot_win := self.plot_windows.get(name)) is None:
+            plot_win = PlotWindow()
+            plot_win.setWindowTitle(name)
+            plot(plot_win)
+            self.plot_windows[name] = plot_win
 
-        return master_wave, wave_offset
+        plot_win.show()
+        plot_win.raise_()
+        return plot_win
 
 
     def setup(self):
         self.n_stars_min = 1
 
-        fit_list = util.get_fits_names(
-            self.input_cmd["path_light_short"])
-        short_wave_fit_list = fit_list
-        n_short_light = len(fit_list)
-
-        if n_short_light == 0:
-            return QMessageBox.warning(self, 
-                "File not found",
-                f"Could not find short wave files at {self.input_cmd['path_light_short']}")
+        pipeline.scan_directories(self.bands, self.input_cmd, self.frame_index)
 
-        long_wave_fit_list = util.get_fits_names(
-            self.input_cmd["path_light_long"])
-        n_long_light = len(long_wave_fit_list)
-        fit_list.extend(long_wave_fit_list)
+        band_frames = [pipeline.select_frames(band, self.input_cmd, self.frame_index) for band in self.bands]
 
-        if n_long_light == 0:
-            return QMessageBox.warning(self,
-                "File not found",
-                f"Could not find short wave files at {self.input_cmd['path_light_long']}")
-
-        scidata = util.fits_to_array(fit_list)
-        pixel = scidata[0].shape
+        for frames in band_frames:
+            if len(frames.lights) == 0:
+                return QMessageBox.warning(self,
+                    "File not found",
+                    f"Could not find {frames.band.name} files at {frames.band.path_light}")
 
-        if self.input_cmd["do_dark"]:
-            self.dark_correction(scidata, n_short_light)
+        # calibration and stacking of the bands are independent of each other and run concurrently
+        results = pipeline.reduce_bands(band_frames, self.input_cmd)
 
-        if self.input_cmd["do_flat"]:
-            self.flat_fielding(scidata, n_short_light)
+        for result in results:
+            self.logger.extend(result.log)
+            for warning in result.warnings:
+                QMessageBox.warning(self, f"{result.band.name} reduction", warning)
 
-        # here the master lights are created, after each picture was offset-aligned regarding your input
-        master_short_wave, self.short_wave_offset = self.master_wave(
-            scidata[:n_short_light, :, :], n_short_light, pixel)
-        master_long_wave, self.long_wave_offset = self.master_wave(
-            scidata[n_short_light:n_short_light + n_long_light, :, :], n_long_light, pixel)
+        self.band_offsets = [result.offset for result in results]
 
-        # TODO no copying
-        scidata = np.zeros((2, pixel[0], pixel[1]))
-        scidata[0, :, :] = master_short_wave
-        scidata[1, :, :] = master_long_wave
+        scidata = np.array([result.master for result in results])
+        pixel = scidata[0].shape
+        self.pixel = pixel
 
-        del master_long_wave, master_short_wave
+        # Masters are aligned to the first light of the reference band, so its WCS (if any) describes the star positions
+        self.reference_header = fits.getheader(results[0].lights[0], 0)
 
-        self.save_fits_files(scidata, n_short_light, n_long_light, short_wave_fit_list, long_wave_fit_list)
+        pipeline.save_masters(results, scidata, self.input_cmd["path_result"])
 
         # We don't need rescaling as we got zoom
 
-        reference_fit = 0  # 0 = short wavelength; 1 = long wavelength
-        scidata_frame = scidata[reference_fit]
-
-        # subtract sky background and set negative values to 0
-        _, median, _ = util.get_stats(scidata_frame)
-        data2show = np.maximum(np.zeros(scidata_frame.shape), scidata_frame - median)
-
-        # equalize the histogram or use log scaling for nicer display of image
-        # array2show = np.uint16(aux.histeq(data2show,rescaled_pixel)/255)    # convert from 16 Bit to 8 Bit only for display
-        array2show = np.uint16(util.hist_log(data2show) / 255)  # convert from 16 Bit to 8 Bit only for display
+        reference_fit = 0  # index of the band all other bands are aligned to
 
-        image2show = Image.fromarray(array2show, mode='I;16')
-        self.scene.addPixmap(image2show.toqpixmap())
+        self.init_fhd(reference_fit, scidata)
 
-        self.init_fhd(reference_fit, scidata, pixel)
+        # Masters are aligned by init_fhd now, so blinking between them shows the same stars in place
+        self.frame_item = FrameGraphicsItem(scidata)
+        self.frame_item.setZValue(-1)
+        self.frame_item.show_frame(reference_fit)
+        self.scene.addItem(self.frame_item)
 
+        if self.input_cmd["path_catalogue"]:
+            self.label_from_catalogue(self.input_cmd["path_catalogue"])
 
-    def init_fhd(self, reference_fit, scidata, pixel):
-        """Initialize pictures and data"""
 
-        n_fits = len(scidata[:, 0, 0])
-        FWHM = self.input_cmd["FWHM"]
-        r_aperture = self.input_cmd["r_aperture"]
-        _, median, std = util.get_stats(scidata)
-        self.offset = util.get_offset(scidata, median, std, reference_fit)
+    def init_fhd(self, reference_fit, scidata):
+        """Shared alignment, detection and photometry of all masters"""
 
-        # shift and pad the images; we want the original number of pixel -> only part of the padded array needed
-        self.shift_data(scidata, n_fits, self.offset, pixel)
+        self.offset, median, std = pipeline.align_masters(scidata, reference_fit)
 
-        # the stars of the images are found here and the positions are saved
-        _, self.n_stars_min, self.positions = util.detect_star(self.n_stars_min, scidata, median, std, FWHM, self.input_cmd["ratio"], self.input_cmd["threshold"])
-        stars_flux = np.zeros((n_fits, self.n_stars_min))
+        self.n_stars_min, self.positions, stars_flux, detected = pipeline.measure_stars(
+            scidata, median, std, self.input_cmd, self.n_stars_min)
 
-        # stars flux are only numbers, they are made from a circle around the position of a star and the sum of it.
-        for i in range(n_fits):
-            arr2d = [
-                [self.positions[i, a, 0], self.positions[i, a, 1]]
-                for a in range(len(self.positions[i, :, 0]))
-            ]
+        # creating the ovals around the stars for user input, all drawn by one item
+        r_aperture = self.input_cmd["r_aperture"] * self.input_cmd["FWHM"]
+        self.star_field = StarField(self.positions[reference_fit], 3 / 2 * r_aperture, self.band_names)
+        self.star_field.flux[:, :] = stars_flux
+        self.star_field.detected[:, :] = detected
 
-            apertures = CircularAperture(arr2d, r=r_aperture * FWHM)  # the area, where the flux is going to be taken from
-            phot = aperture_photometry(scidata[i, :, :] - median[i], apertures)  # the numbers are generated from the specific area of 'apertures'
-            stars_flux[i, :] = phot['aperture_sum'][0:self.n_stars_min]  # numbers, that represent the luminosity of a star. Not real flux, but similar
-
-        # creating the ovals around the stars for user input
-        for j in range(self.n_stars_min):
-            e = StarEllipse(
-                QRect(
-                    QPoint(self.positions[reference_fit, j, 0] - 3 / 2 * r_aperture * FWHM,
-                           self.positions[reference_fit, j, 1] - 3 / 2 * r_aperture * FWHM,),
-                    QPoint(self.positions[reference_fit, j, 0] + 3 / 2 * r_aperture * FWHM,
-                           self.positions[reference_fit, j, 1] + 3 / 2 * r_aperture * FWHM,)
-                ),
-            )
-            e.index = j
-            e.flux1 = stars_flux[0, j]
-            e.flux2 = stars_flux[1, j]
-
-            self.scene.addItem(e)
+        self.scene.addItem(self.star_field)
+        self.graphics_view.star_field = self.star_field
 
         self.logger.append(f"""
         Found {self.n_stars_min} Stars
@@ -279,133 +200,164 @@ class MainWindow(QWidget):
         """)
 
 
-    def save_fits_files(self, scidata, n_short_light, n_long_light, short_wave_FIT_list, long_wave_FIT_list):
-        path_save = Path(self.input_cmd["path_result"])
-
-        if not path_save.exists():
-            path_save.mkdir(parents=True)
+    @Slot()
+    def button_offset_master_clicked(self):
+        self.show_plot_window("Masters Offset", lambda win: win.plot_offset(self.offset))
 
-        timestamp = datetime.now()
 
-        hdulist_short = fits.HDUList(fits.PrimaryHDU(data=scidata[0, :, :]))
-        with fits.open(short_wave_FIT_list[0]) as hdul:
-            hdulist_short[0].header = hdul[0].header
+    def button_offset_band_clicked(self, band: int):
+        self.show_plot_window(f"{self.band_names[band]} Offset", lambda win: win.plot_offset(self.band_offsets[band]))
 
-        hdulist_short[0].header['BZERO'] = 0.0
-        hdulist_short[0].header['SNAPSHOT'] = n_short_light
-        hdulist_short[0].header['Date'] = timestamp.strftime("%Y-%m-%d")
-        hdulist_short[0].header['Note'] = 'Created by colour_magnitude_diagram.py'
 
-        hdulist_long = fits.HDUList(fits.PrimaryHDU(data=scidata[1, :, :]))
-        with fits.open(long_wave_FIT_list[0]) as hdul:
-            hdulist_long[0].header = hdul[0].header
+    @Slot()
+    def levels_changed(self):
+        if self.frame_item is not None:
+            self.frame_item.set_levels(self.black_box.value(), self.white_box.value(), self.stretch_box.currentText())
 
-        hdulist_long[0].header['BZERO'] = 0.0
-        hdulist_long[0].header['SNAPSHOT'] = n_long_light
-        hdulist_long[0].header['Date'] = timestamp.strftime("%Y-%m-%d")
-        hdulist_long[0].header['Note'] = 'Created by colour_magnitude_diagram.py'
 
-        tme = timestamp.strftime("%Y-%m-%dT%H-%M-%S")
+    @Slot()
+    def button_blink_clicked(self):
+        """Switches the displayed master to the next band"""
+        if self.frame_item is None:
+            return
 
-        hdulist_short.writeto(path_save / f"{self.input_cmd['short_colour']}_{tme}.fits", overwrite=True)
-        hdulist_long.writeto(path_save / f"{self.input_cmd['long_colour']}_{tme}.fits", overwrite=True)
+        current = (self.frame_item.current + 1) % len(self.band_names)
+        self.frame_item.show_frame(current)
+        self.button_blink.setText(f"Blink ({self.band_names[current]})")
 
 
     @Slot()
-    def button_offset_master_clicked(self):
-        plot_win = self.create_plot_window()
-        plot_win.plot_offset(self.offset)
-        plot_win.show()
+    def button_toggle_selection_clicked(self):
+        """Toggles selection of ALL Stars"""
+        if self.star_field is not None:
+            self.star_field.toggle(slice(None))
 
 
     @Slot()
-    def button_offset_short_clicked(self):
-        plot_win = self.create_plot_window()
-        plot_win.plot_offset(self.short_wave_offset)
-        plot_win.show()
+    def button_catalogue_clicked(self):
+        if self.star_field is None:
+            return
 
+        path_catalogue, _ = QFileDialog.getOpenFileName(
+            self, "Load reference catalogue", self.input_cmd["path_catalogue"],
+            "Catalogues (*.csv *.fits *.fit *.fts);;All files (*)")
 
-    @Slot()
-    def button_offset_long_clicked(self):
-        plot_win = self.create_plot_window()
-        plot_win.plot_offset(self.long_wave_offset)
-        plot_win.show()
+        if path_catalogue:
+            self.label_from_catalogue(path_catalogue)
 
 
     @Slot()
-    def button_toggle_selection_clicked(self):
-        """Toggles selection of ALL Stars"""
-        for star in self.graphics_view.stars():
-            star.status ^= StarStatus.Selected
+    def button_preview_clicked(self):
+        """The diagram follows all later changes of selection, labels and reddening by itself"""
 
+        def plot(win: PlotWindow):
+            win.saving.connect(self.save_fhd_files)
+            win.plot_fhd(self.star_field, self.reddening_box.value())
 
-    @Slot()
-    def button_preview_clicked(self):
-        plot_win = self.create_plot_window()
-        plot_win.saving.connect(self.save_fhd_files)
+        self.show_plot_window("FHD Diagram", plot)
 
-        plot_win.plot_fhd(self.n_stars_min, list(self.graphics_view.stars()), self.input_cmd, self.reddening_box.value())
-        plot_win.show()
 
+    @Slot()
+    def reddening_changed(self):
+        if plot_win := self.plot_windows.get("FHD Diagram"):
+            plot_win.set_reddening(self.reddening_box.value())
 
-    @Slot(StarEllipse)
-    def info_star(self, star: StarEllipse):
+
+    @Slot(int)
+    def info_star(self, star: int):
         """Set values of one star"""
 
-        # Ask for both values
-        typed_mag_1, ok = QInputDialog.getDouble(self, "Input short colour", f"Input {self.input_cmd['short_colour']}", value=star.vmag1, decimals=3)
-        if not ok:
-            return QMessageBox.warning(self, "Aborting", "Expected valid floating point number")
+        # Ask for one value per band, 0 means no reference magnitude in that band
+        typed_mags = []
+        for i, name in enumerate(self.band_names):
+            typed_mag, ok = QInputDialog.getDouble(self, f"Input {name}", f"Input {name}", value=self.star_field.vmag[i, star], decimals=3)
+            if not ok:
+                return QMessageBox.warning(self, "Aborting", "Expected valid floating point number")
+            typed_mags.append(typed_mag)
 
-        typed_mag_2, ok = QInputDialog.getDouble(self, "Input long colour", f"Input {self.input_cmd['long_colour']}", value=star.vmag2, decimals=3)
-        if not ok:
-            return QMessageBox.warning(self, "Aborting", "Expected valid floating point number")
+        # Update star, status and colour are adjusted automatically. All values 0 set the star back to standard
+        self.star_field.label(star, typed_mags)
 
-        # Update star
-        star.vmag1 = typed_mag_1
-        star.vmag2 = typed_mag_2
+        if not any(typed_mags):
+            self.logger.append(f"Unset {star}")
+        else:
+            self.logger.append(f"Set {star} to {' and '.join(map(str, typed_mags))}")
 
-        # Change status: Colour etc. will be adjusted automatically
 
-        # Unset star if both values are 0
-        if typed_mag_1 == 0.0 and typed_mag_2 == 0.0:
-            self.logger.append(f"Unset {star.index}")
-            star.status &= ~StarStatus.Labeled
-            star.setToolTip("")
-        else:
-            self.logger.append(f"Set {star.index} to {typed_mag_1} and {typed_mag_2}")
-            star.status |= StarStatus.Labeled
-            star.setToolTip(f"{self.input_cmd['short_colour']}: {typed_mag_1} | {self.input_cmd['long_colour']}: {typed_mag_2}")
+    def label_from_catalogue(self, path_catalogue: Path | str):
+        """Cross-matches a reference catalogue with the detected stars and labels all matches"""
+
+        columns = self.input_cmd["catalogue_columns"]
+
+        if len(columns) != 2 + len(self.band_names):
+            return QMessageBox.warning(self, "Catalogue not loaded",
+                f"catalogue_columns needs x, y and one magnitude per band ({', '.join(self.band_names)}), got {columns}")
+
+        try:
+            with catalogue.load_catalogue(path_catalogue, columns) as cat:
+                cat_xy, rows = catalogue.project_catalogue(
+                    cat, columns, self.pixel, self.reference_header, self.input_cmd["catalogue_anchors"])
 
+                star_idx, cat_idx = catalogue.cross_match(self.positions[0], cat_xy, self.input_cmd["catalogue_radius"])
 
-    @Slot(np.ndarray, np.ndarray)
-    def save_fhd_files(self, mag_short: np.ndarray, mag_long: np.ndarray):
-        """Called from PlotWindow to save fhd data"""
+                # one magnitude column per band, missing values (NaN) become 0: no reference in that band
+                mags = np.array([cat[column][rows[cat_idx]] for column in columns[2:2 + len(self.band_names)]], dtype=np.float64)
+        except (OSError, KeyError, ValueError) as e:
+            return QMessageBox.warning(self, "Catalogue not loaded", f"Could not use catalogue {path_catalogue}: {e}")
 
-        swc = self.input_cmd["short_colour"]
-        lwc = self.input_cmd["long_colour"]
+        valid = np.any(np.isfinite(mags), axis=0)
 
-        save_file = Path(self.input_cmd["path_result"]) / f"colour_mag_diagram_{swc}-{lwc}_{datetime.now().strftime('%Y-%m-%dT%H-%M-%S')}.dat"
+        self.star_field.label(star_idx[valid], np.round(np.nan_to_num(mags[:, valid], nan=0.0), 3))
+
+        self.logger.append(f"Labeled {np.count_nonzero(valid)} stars from catalogue {path_catalogue}")
+        QMessageBox.information(self, "Catalogue loaded",
+                                f"Labeled {np.count_nonzero(valid)} of {self.n_stars_min} stars from {path_catalogue}")
+
+
+    @Slot(np.ndarray)
+    def save_fhd_files(self, mags: np.ndarray):
+        """Called from PlotWindow to save fhd data, mags has one row per band"""
+
+        save_file = Path(self.input_cmd["path_result"]) / f"colour_mag_diagram_{'-'.join(self.band_names)}_{datetime.now().strftime('%Y-%m-%dT%H-%M-%S')}"
 
         save_file.parent.mkdir(parents=True, exist_ok=True)
 
-        with save_file.open("w+") as fl:
-            fl.write(
-                f"#ID\tx[px]\ty[px]\tflux_{swc}[ADU]\tflux_{lwc}[ADU]\t{swc}_mag\t{lwc}_mag\n")
-            lines = [
-                f"{star.index:03d}\t{self.positions[0,star.index,0]:5.1f}\t{self.positions[0,star.index,1]:5.1f}\t"
-                f"{star.flux1:10.4f}\t{star.flux2:10.4f}\t"
-                f"{mag_short[star.index]:8.4f}\t{mag_long[star.index]:8.4f}\n"
-                for star in filter(lambda x: StarStatus.Selected in x.status, self.graphics_view.stars())]
-            fl.writelines(lines)
+        # The writer runs in another thread, so it gets copies of everything the GUI may still change
+        labeled = (self.star_field.status & StarStatus.Labeled) != 0
+        columns = [CatalogueColumn("ID", np.arange(len(self.star_field)), "%03d")]
+
+        for i, band in enumerate(self.band_names):
+            columns.append(CatalogueColumn(f"x_{band}", self.positions[i, :, 0].copy(), "%7.2f", "pix"))
+            columns.append(CatalogueColumn(f"y_{band}", self.positions[i, :, 1].copy(), "%7.2f", "pix"))
+
+        for i, band in enumerate(self.band_names):
+            reference = labeled & (self.star_field.vmag[i] != 0.0)
+            columns.append(CatalogueColumn(f"flux_{band}", self.star_field.flux[i].copy(), "%10.4f", "adu"))
+            columns.append(CatalogueColumn(f"{band}_mag", np.array(mags[i], dtype=np.float64), "%8.4f", "mag"))
+            columns.append(CatalogueColumn(f"{band}_ref", np.where(reference, self.star_field.vmag[i], np.nan), "%8.4f", "mag"))
+            columns.append(CatalogueColumn(f"detected_{band}", self.star_field.detected[i].astype(np.uint8), "%d"))
+
+        columns.append(CatalogueColumn("status", self.star_field.status.copy(), "%d"))
+
+        writer = CatalogueWriter(save_file, columns, self.input_cmd["export_formats"])
+        writer.signals.finished.connect(self.catalogue_written)
+        writer.signals.failed.connect(self.catalogue_failed)
+
+        self.catalogue_writers.add(writer)
+        QThreadPool.globalInstance().start(writer)
 
-        QMessageBox.information(self, "Data saved", f"Data written to {save_file}")
 
+    @Slot(object, list)
+    def catalogue_written(self, writer: CatalogueWriter, files: list[str]):
+        """Called (in the GUI thread) once a CatalogueWriter is done"""
 
-    @Slot(QWidget)
-    def plot_window_closed(self, win: QWidget):
-        """Delete PlotWindows from set to free memory"""
-        self.plot_windows.remove(win)
+        self.catalogue_writers.discard(writer)
+        self.logger.append(f"Catalogue written to {', '.join(files)}")
+        QMessageBox.information(self, "Data saved", "Data written to\n" + "\n".join(files))
 
 
+    @Slot(object, str)
+    def catalogue_failed(self, writer: CatalogueWriter, message: str):
+        self.catalogue_writers.discard(writer)
+        QMessageBox.warning(self, "Data not saved", f"Could not write catalogue: {message}")
 
@@ -0,0 +1,303 @@
+import numpy as np
+from astropy.io import fits
+from photutils.aperture import CircularAperture, aperture_photometry
+
+import tomllib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import NamedTuple
+
+import util
+from frame_index import FrameIndex
+from psf_photometry import psf_photometry
+
+
+# Values of keys added after the first release, so older input_cmd.toml files keep working.
+# Older files behave as before: all darks and flats of a directory, no prescreening,
+# aperture photometry of stars found in every master
+DEFAULTS = {
+    "date_from": "",
+    "date_to": "",
+    "match_exptime": False,
+    "export_formats": ["dat"],
+    "band_workers": 0,
+    "do_prescreen": False,
+    "prescreen_binning": 2,
+    "min_star_fraction": 0.5,
+    "max_fwhm_factor": 1.5,
+    "max_noise_factor": 2.0,
+    "max_background_sigma": 10.0,
+    "detection": "each",
+    "snr_min": 3.0,
+    "photometry": "aperture",
+    "psf_tile_size": 512,
+    "psf_workers": 0,
+    "path_catalogue": "",
+    "catalogue_columns": ["RA", "DEC", "B", "V"],
+    "catalogue_radius": 3.0,
+    "catalogue_anchors": [],
+}
+
+
+def load_config(path: Path | str) -> dict:
+    """Reads input_cmd.toml, missing keys get their DEFAULTS"""
+
+    with open(path, "rb") as fl:
+        input_cmd = DEFAULTS | tomllib.load(fl)
+
+    # the frame index lives beside the results unless configured otherwise
+    input_cmd.setdefault("path_index", str(Path(input_cmd["path_result"]) / "frame_index.sqlite"))
+
+    return input_cmd
+
+
+class Band(NamedTuple):
+    name: str
+    path_light: str
+    path_dark: str
+    path_flat: str
+
+
+class BandFrames(NamedTuple):
+    """All files needed to reduce one band, selected from the frame index"""
+
+    band: Band
+    lights: list[Path]
+    darks: list[Path]
+    flats: list[Path]
+    flat_darks: list[Path]
+    log: list[str]
+
+
+class BandResult(NamedTuple):
+    band: Band
+    lights: list[Path]      # lights used for the master, after prescreening
+    master: np.ndarray
+    offset: np.ndarray      # offset of every light relative to the first one
+    log: list[str]
+    warnings: list[str]
+
+
+def bands_from_config(input_cmd: dict) -> list[Band]:
+    """Bands from the [[bands]] tables of input_cmd.toml. Older files with the
+    short/long wave keys are read as two bands"""
+
+    if "bands" in input_cmd:
+        return [Band(b["name"], b["path_light"], b["path_dark"], b["path_flat"]) for b in input_cmd["bands"]]
+
+    return [
+        Band(input_cmd["short_colour"], input_cmd["path_light_short"], input_cmd["path_dark_short"], input_cmd["path_flat_short"]),
+        Band(input_cmd["long_colour"], input_cmd["path_light_long"], input_cmd["path_dark_long"], input_cmd["path_flat_long"]),
+    ]
+
+
+def scan_directories(bands: list[Band], input_cmd: dict, frame_index: FrameIndex):
+    """Brings the frame index up to date, only new or modified files are opened"""
+
+    for band in bands:
+        for directory in (band.path_light, band.path_dark, band.path_flat):
+            frame_index.scan(directory)
+
+    frame_index.scan(input_cmd["path_dark_flat"])
+
+
+def find_frames(frame_index: FrameIndex, directory: str, input_cmd: dict, match_to: list[Path] | None = None,
+                log: list[str] | None = None) -> list[Path]:
+    """Looks up the FITS files of directory in the frame index.
+    With match_exptime set, only frames sharing the exposure time of match_to (or without any) are returned.
+    Frames used without known exposure time are reported in log"""
+
+    query = {}
+
+    if match_to and input_cmd["match_exptime"]:
+        # Mixed exposure times cannot be matched by a single dark/flat set, use everything then
+        if len(exptimes := frame_index.exptimes(match_to)) == 1:
+            query["exptime"] = exptimes.pop()
+
+    frames = frame_index.select(directory, **query)
+
+    if "exptime" in query and log is not None and (unknown := frame_index.without_exptime(frames)):
+        log.append(f"{len(unknown)} frames of {directory} have no exposure time, used for {query['exptime']} s anyway: "
+                   + ", ".join(fit_name.name for fit_name in unknown))
+
+    return frames
+
+
+def select_frames(band: Band, input_cmd: dict, frame_index: FrameIndex) -> BandFrames:
+    """Queries the frame index for one band. Has to run in the thread owning frame_index"""
+
+    # Light frames restricted to the configured observation dates
+    lights = frame_index.select(band.path_light, date_from=input_cmd["date_from"], date_to=input_cmd["date_to"])
+    log = []
+    darks = find_frames(frame_index, band.path_dark, input_cmd, lights, log) if input_cmd["do_dark"] else []
+    flats = find_frames(frame_index, band.path_flat, input_cmd) if input_cmd["do_flat"] else []
+    flat_darks = find_frames(frame_index, input_cmd["path_dark_flat"], input_cmd, flats, log) if input_cmd["do_dark_flat"] else []
+
+    return BandFrames(band, lights, darks, flats, flat_darks, log)
+
+
+def prescreen(fit_list: list[Path], input_cmd: dict, name: str = "") -> tuple[list[Path], list[str], list[str]]:
+    """Rejects bad lights (clouds, trailing, focus) on binned frames, before any full resolution work is done.
+    Frames are compared to the median frame of the list, so at least three frames are needed.
+    Returns the kept frames, a log line per frame and a line per rejected (or kept though bad) frame"""
+
+    if not input_cmd["do_prescreen"] or len(fit_list) < 3:
+        return fit_list, [], []
+
+    metrics = [
+        util.frame_quality(fits.getdata(fit_name, 0), input_cmd["FWHM"], input_cmd["ratio"],
+                           input_cmd["threshold"], input_cmd["prescreen_binning"])
+        for fit_name in fit_list
+    ]
+
+    keep, reasons = util.reject_frames(metrics, input_cmd["min_star_fraction"], input_cmd["max_fwhm_factor"],
+                                       input_cmd["max_noise_factor"], input_cmd["max_background_sigma"])
+
+    # every frame failed: the best one is kept, so the band can still be stacked
+    verdict = lambda k, reason: ("" if not reason else
+                                 f" -> rejected: {'; '.join(reason)}" if not k else
+                                 f" -> kept as best of all failing frames: {'; '.join(reason)}")
+
+    log = [
+        f"Prescreen {name} {fit_name.name}: background {background:.1f}, noise {noise:.1f}, {n_stars} stars, FWHM {fwhm:.2f} px"
+        + verdict(k, reason)
+        for fit_name, (background, noise, n_stars, fwhm), k, reason in zip(fit_list, metrics, keep, reasons)
+    ]
+    rejected = [f"{fit_name.name}{verdict(k, reason)}" for fit_name, k, reason in zip(fit_list, keep, reasons) if reason]
+
+    return [fit_name for fit_name, k in zip(fit_list, keep) if k], log, rejected
+
+
+def reduce_band(frames: BandFrames, input_cmd: dict) -> BandResult:
+    """Prescreening, dark correction, flat fielding, alignment and stacking of one band.
+    Independent of all other bands, so bands can be reduced concurrently"""
+
+    name = frames.band.name
+    warnings = []
+
+    lights, log, rejected = prescreen(frames.lights, input_cmd, name)
+    log = frames.log + log
+    if rejected:
+        warnings.append(f"Prescreening of {name} frames:\n" + "\n".join(rejected))
+
+    if not lights:
+        raise FileNotFoundError(f"No usable {name} lights at {frames.band.path_light}")
+
+    scidata = util.fits_to_array(lights)
+    pixel = scidata[0].shape
+
+    if input_cmd["do_dark"]:
+        if frames.darks:
+            scidata = util.dark_correction(scidata, util.fits_to_array(frames.darks))
+        else:
+            warnings.append(f"Could not find files for {name} dark correction")
+
+    if input_cmd["do_flat"]:
+        if frames.flats:
+            flats = util.fits_to_array(frames.flats)
+
+            if input_cmd["do_dark_flat"]:
+                if frames.flat_darks:
+                    flats = util.dark_correction(flats, util.fits_to_array(frames.flat_darks))
+                else:
+                    warnings.append(f"Could not find files for dark correction of {name} flats")
+
+            scidata = util.flat_correction(scidata, flats)
+        else:
+            warnings.append(f"Could not find files for {name} flatfielding")
+
+    # here the master light is created, after each picture was offset-aligned
+    n_light = len(lights)
+    if n_light > 1:
+        _, median, std = util.get_stats(scidata)
+        offset = util.get_offset(scidata, median, std, 0)
+        util.shift_data(scidata, n_light, offset, pixel)
+        master = util.create_master(scidata)
+    else:
+        offset = np.zeros((n_light, 2), dtype=int)
+        master = scidata[0]
+
+    return BandResult(frames.band, lights, master, offset, log, warnings)
+
+
+def reduce_bands(band_frames: list[BandFrames], input_cmd: dict) -> list[BandResult]:
+    """Reduces all bands concurrently. NumPy, SciPy and astropy release the GIL in the expensive parts"""
+
+    n_workers = input_cmd["band_workers"] or len(band_frames)
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(lambda frames: reduce_band(frames, input_cmd), band_frames))
+
+
+def align_masters(masters: np.ndarray, reference_fit: int = 0) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Shifts all masters (in place) onto the reference master. Returns offsets, medians and standard deviations"""
+
+    _, median, std = util.get_stats(masters)
+    offset = util.get_offset(masters, median, std, reference_fit)
+
+    # shift and pad the images; we want the original number of pixel -> only part of the padded array needed
+    util.shift_data(masters, len(masters), offset, masters[0].shape)
+
+    return offset, median, std
+
+
+def measure_stars(masters: np.ndarray, median: np.ndarray, std: np.ndarray, input_cmd: dict, n_stars_min: int = 1):
+    """Shared star detection and photometry (aperture or PSF fitting) of all aligned masters.
+    Returns number of stars, positions (n_bands, n_stars, 2), fluxes and detection flags (n_bands, n_stars)"""
+
+    FWHM = input_cmd["FWHM"]
+    r_aperture = input_cmd["r_aperture"]
+
+    # the stars of the images are found here and the positions are saved
+    # "combined": detect once on the summed masters and measure all bands at those positions
+    detect = util.detect_star_combined if input_cmd["detection"] == "combined" else util.detect_star
+    _, n_stars, positions = detect(n_stars_min, masters, median, std, FWHM, input_cmd["ratio"], input_cmd["threshold"])
+
+    stars_flux = np.zeros((len(masters), n_stars))
+
+    if input_cmd["photometry"] == "psf":
+        # crowded fields: neighbours are fitted together instead of contaminating each other's aperture
+        stars_flux[:, :] = psf_photometry(masters - median[:, None, None], positions[:, :n_stars], FWHM, r_aperture * FWHM,
+                                          input_cmd["psf_tile_size"], input_cmd["psf_workers"])
+    else:
+        # stars flux are only numbers, they are made from a circle around the position of a star and the sum of it.
+        for i in range(len(masters)):
+            apertures = CircularAperture(positions[i], r=r_aperture * FWHM)  # the area, where the flux is going to be taken from
+            phot = aperture_photometry(masters[i] - median[i], apertures)  # the numbers are generated from the specific area of 'apertures'
+            stars_flux[i, :] = phot['aperture_sum'][0:n_stars]  # numbers, that represent the luminosity of a star. Not real flux, but similar
+
+    # with forced photometry a star need not be significant in every band,
+    # stars found in every master separately are detected everywhere by definition
+    if input_cmd["detection"] == "combined":
+        detected = util.detection_flags(stars_flux, std, r_aperture * FWHM, input_cmd["snr_min"])
+    else:
+        detected = np.ones(stars_flux.shape, dtype=bool)
+
+    return n_stars, positions, stars_flux, detected
+
+
+def save_masters(results: list[BandResult], masters: np.ndarray, path_result: Path | str, timestamp: datetime | None = None) -> list[Path]:
+    """Writes every master with the header of its first light"""
+
+    path_save = Path(path_result)
+    path_save.mkdir(parents=True, exist_ok=True)
+
+    timestamp = timestamp or datetime.now()
+    tme = timestamp.strftime("%Y-%m-%dT%H-%M-%S")
+    written = []
+
+    for result, master in zip(results, masters):
+        hdulist = fits.HDUList(fits.PrimaryHDU(data=master))
+        with fits.open(result.lights[0]) as hdul:
+            hdulist[0].header = hdul[0].header
+
+        hdulist[0].header['BZERO'] = 0.0
+        hdulist[0].header['SNAPSHOT'] = len(result.lights)
+        hdulist[0].header['Date'] = timestamp.strftime("%Y-%m-%d")
+        hdulist[0].header['Note'] = 'Created by colour_magnitude_diagram.py'
+
+        written.append(path_save / f"{result.band.name}_{tme}.fits")
+        hdulist.writeto(written[-1], overwrite=True)
+
+    return written
@@ -1,19 +1,51 @@
-from PySide6.QtWidgets import QWidget, QHBoxLayout, QVBoxLayout, QPushButton, QMessageBox
+from PySide6.QtWidgets import QWidget, QHBoxLayout, QVBoxLayout, QPushButton, QMessageBox, QComboBox, QLabel
 from PySide6.QtCore import Signal, Slot
 
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg
 
 import numpy as np
 
-from star_ellipse import StarEllipse, StarStatus
+from star_field import StarField, StarStatus
 
 
-class PlotWindow(QWidget):
-    # Signal is emitted when the window is closed. Used to remove it from the MainWindow list
-    closed = Signal(QWidget)
+class Colours:
+    Point = (0.0, 0.0, 1.0, 1.0)
+
+
+class LinearFit:
+    """Least squares straight line, kept as running sums so points can be added and removed
+    without refitting all of them"""
+
+    def __init__(self):
+        # n, sum x, sum y, sum x^2, sum xy
+        self.sums = np.zeros(5)
+
+
+    def add(self, x: np.ndarray, y: np.ndarray, sign: float = 1.0):
+        self.sums += sign * np.array([len(x), np.sum(x), np.sum(y), np.sum(x * x), np.sum(x * y)])
+
+
+    def remove(self, x: np.ndarray, y: np.ndarray):
+        self.add(x, y, -1.0)
+
+
+    def coefficients(self) -> tuple[float, float]:
+        """Returns slope and intercept. With a single (or degenerate) reference the slope is fixed to 1"""
+
+        n, sx, sy, sxx, sxy = self.sums
+        det = n * sxx - sx * sx
+
+        if n >= 2 and det > 1e-9 * n * n:
+            slope = (n * sxy - sx * sy) / det
+        else:
+            slope = 1.0
 
-    # Signal is emitted when fhd data should be saved
-    saving = Signal(np.ndarray, np.ndarray)
+        return slope, (sy - slope * sx) / n
+
+
+class PlotWindow(QWidget):
+    # Signal is emitted when fhd data should be saved, with one row of magnitudes per band
+    saving = Signal(np.ndarray)
 
 
     def __init__(self, *args, **kwargs):
@@ -22,28 +54,28 @@ class PlotWindow(QWidget):
         self.figure_canvas = FigureCanvasQTAgg()
 
         # Used to save fhd data
-        self.mag_short = None
-        self.mag_long = None
+        self.mags = None
+        self.points = None
 
-        button_stack = QVBoxLayout()
+        self.button_stack = QVBoxLayout()
 
         save_button = QPushButton("Save Data")
         save_button.clicked.connect(self.save_button_clicked)
-        button_stack.addWidget(save_button)
+        self.button_stack.addWidget(save_button)
 
-        button_stack.addStretch()
+        self.button_stack.addStretch()
 
         self.layout = QHBoxLayout(self)
         self.layout.addWidget(self.figure_canvas)
-        self.layout.addLayout(button_stack)
+        self.layout.addLayout(self.button_stack)
 
         self.resize(800, 600)
 
 
-    def closeEvent(self, event):
-        """Informs MainWindow that we would like to close"""
-        self.closed.emit(self)
-        super().closeEvent(event)
+    def showEvent(self, event):
+        """Updates while hidden are not blitted, so redraw everything"""
+        self.figure_canvas.draw_idle()
+        super().showEvent(event)
 
 
     def plot_offset(self, offset):
@@ -76,75 +108,182 @@ class PlotWindow(QWidget):
     @Slot()
     def save_button_clicked(self):
         """Informs MainWindow we would like to save data"""
-        if self.mag_long is not None and self.mag_short is not None:
-            self.saving.emit(self.mag_short, self.mag_long)
+        if self.mags is not None:
+            self.saving.emit(self.mags)
         else:
             QMessageBox.information(self, "No valid Data", "Saving is only supported for FHD-Plots")
 
 
-    def plot_fhd(self, n_stars_min: int, stars: list[StarEllipse], input_cmd: dict, reddening: float):
-        ax = self.figure_canvas.figure.subplots()
+    def plot_fhd(self, star_field: StarField, reddening: float):
+        """Plots the colour magnitude diagram and keeps it up to date with star_field.
+        Selection changes only recolour the affected points and are blitted,
+        label changes update the calibration fit incrementally"""
+
+        self.star_field = star_field
+        self.reddening = reddening
+
+        n_bands = len(star_field.band_names)
+        n_stars = len(star_field)
+
+        # colour index (colour_a - colour_b) and magnitude band shown, default like short-long / long
+        self.colour_a, self.colour_b, self.mag_band = 0, 1, 1
+
+        for label, attribute in (("Colour", "colour_a"), ("minus", "colour_b"), ("Magnitude", "mag_band")):
+            box = QComboBox()
+            box.addItems(star_field.band_names)
+            box.setCurrentIndex(getattr(self, attribute))
+            box.currentIndexChanged.connect(lambda index, attribute=attribute: self.set_combination(attribute, index))
+            self.button_stack.insertWidget(self.button_stack.count() - 1, QLabel(label))
+            self.button_stack.insertWidget(self.button_stack.count() - 1, box)
+
+        self.ax = self.figure_canvas.figure.subplots()
+        self.ax.invert_yaxis()
+
+        # stars without positive flux get no magnitude in that band
+        flux = np.where(star_field.flux > 0, star_field.flux, np.nan)
+
+        # convert fluxes to magnitudes in our own filter system
+        self.mag_RGB = -2.5 * np.log10(flux)
+
+        # conversion from our RGB filters to Johnson UBV filters, fitted per band to all stars labeled in that band
+        self.fits = [LinearFit() for _ in range(n_bands)]
+        self.ref_mask = np.zeros((n_bands, n_stars), dtype=bool)
+        self.ref_mag_UBV = np.zeros((n_bands, n_stars))
+        self.mags = np.zeros((n_bands, n_stars))
+
+        # one point per star, hidden (alpha 0) while deselected
+        self.face_colours = np.zeros((n_stars, 4))
+        self.edge_colours = np.zeros((n_stars, 4))
+        self.points = self.ax.scatter(np.zeros(n_stars), np.zeros(n_stars), s=25, animated=True)
+
+        self.background = None
+        self.figure_canvas.mpl_connect("draw_event", self.on_draw)
 
-        labeled_stars = list(filter(lambda x: StarStatus.Labeled in x.status, stars))
-        n_ref_stars_1 = len(labeled_stars)
+        star_field.status_changed.connect(self.update_selection)
+        star_field.labels_changed.connect(self.update_labels)
 
-        self.mag_short = np.zeros(n_stars_min)
-        self.mag_long = np.zeros(n_stars_min)
+        self.update_selection(np.arange(n_stars))
+        self.update_labels(np.arange(n_stars))
 
-        arbitrary_unit_mag = n_ref_stars_1 <= 0
 
-        if not arbitrary_unit_mag:
-            ref_flux = np.zeros((n_ref_stars_1, 2))
-            ref_mag_RGB = np.zeros((n_ref_stars_1, 2))
-            ref_mag_UBV = np.zeros((n_ref_stars_1, 2))
+    def on_draw(self, event):
+        """Full redraw: remember the static background for blitting, then draw the points on top"""
+        if self.points is None:
+            return
 
-            for i_ref_star, star in enumerate(labeled_stars):
-                ref_flux[i_ref_star, 0] = star.flux1
-                ref_flux[i_ref_star, 1] = star.flux2
-                ref_mag_UBV[i_ref_star, 0] = star.vmag1
-                ref_mag_UBV[i_ref_star, 1] = star.vmag2
+        self.background = self.figure_canvas.copy_from_bbox(self.figure_canvas.figure.bbox)
+        self.ax.draw_artist(self.points)
 
-            # convert fluxes to magnitudes in our own filter system
-            ref_mag_RGB[:, :] = -2.5 * np.log10(ref_flux[:, :])
 
-            # find conversion from our RGB filters to Johnson UBV filters
-            fit_result_short = np.polyfit(ref_mag_RGB[:, 0], ref_mag_UBV[:, 0], 1)
-            fit_result_long = np.polyfit(ref_mag_RGB[:, 1], ref_mag_UBV[:, 1], 1)
+    def blit(self):
+        if self.background is None or not self.isVisible():
+            return self.figure_canvas.draw_idle()
 
-            RGB_UBV_converter_short = np.poly1d(fit_result_short)
-            RGB_UBV_converter_long = np.poly1d(fit_result_long)
+        self.figure_canvas.restore_region(self.background)
+        self.ax.draw_artist(self.points)
+        self.figure_canvas.blit(self.figure_canvas.figure.bbox)
 
-            for star in stars:
-                if star.flux1 > 0 and star.flux2 > 0:
-                    # convert to RGB mags
-                    mag_RGB_short = -2.5 * np.log10(star.flux1)
-                    mag_RGB_long = -2.5 * np.log10(star.flux2)
-                    # convert to UBV mags
-                    self.mag_short[star.index] = RGB_UBV_converter_short(mag_RGB_short)
-                    self.mag_long[star.index] = RGB_UBV_converter_long(mag_RGB_long)
-                else:
-                    self.mag_short[star.index] = None
-                    self.mag_long[star.index] = None
+
+    @Slot(np.ndarray)
+    def update_selection(self, indices: np.ndarray):
+        """Recolours only the points of indices"""
+
+        selected = (self.star_field.status[indices] & StarStatus.Selected) != 0
+        # open circles: not significant in at least one plotted band, measured by forced photometry only
+        bands = list({self.colour_a, self.colour_b, self.mag_band})
+        detected = np.all(self.star_field.detected[np.ix_(bands, indices)], axis=0)
+
+        self.edge_colours[indices] = Colours.Point
+        self.edge_colours[indices, 3] = selected
+        self.face_colours[indices] = Colours.Point
+        self.face_colours[indices, 3] = selected & detected
+
+        self.points.set_edgecolors(self.edge_colours)
+        self.points.set_facecolors(self.face_colours)
+
+        # axes follow the selected stars, so deselecting outliers zooms in on the rest
+        if self.rescale():
+            self.figure_canvas.draw_idle()
         else:
-            ref_flux = [stars[0].flux1, stars[0].flux2]
-            ref_mag_UBV = [10, 10]
+            self.blit()
+
+
+    @Slot(np.ndarray)
+    def update_labels(self, indices: np.ndarray):
+        """Updates the calibration fits by the changed reference stars and recomputes all magnitudes"""
+
+        labeled = (self.star_field.status[indices] & StarStatus.Labeled) != 0
+
+        for band, fit in enumerate(self.fits):
+            # remove old contribution of these stars, then add the new one
+            old = indices[self.ref_mask[band, indices]]
+            fit.remove(self.mag_RGB[band, old], self.ref_mag_UBV[band, old])
+
+            usable = labeled & (self.star_field.vmag[band, indices] != 0.0) & np.isfinite(self.mag_RGB[band, indices])
+            self.ref_mask[band, indices] = usable
+            self.ref_mag_UBV[band, indices] = self.star_field.vmag[band, indices]
+
+            new = indices[usable]
+            fit.add(self.mag_RGB[band, new], self.ref_mag_UBV[band, new])
+
+            if np.any(self.ref_mask[band]):
+                # convert to UBV mags
+                self.mags[band] = np.poly1d(fit.coefficients())(self.mag_RGB[band])
+            else:
+                # without reference stars the first star with a magnitude (positive flux) is set to 10 mag
+                finite = np.flatnonzero(np.isfinite(self.mag_RGB[band]))
+                anchor = self.mag_RGB[band, finite[0]] if len(finite) else np.nan
+                self.mags[band] = self.mag_RGB[band] - anchor + 10
+
+        self.update_positions()
 
-            for star in stars:
-                if star.flux1 > 0 and star.flux2 > 0:
-                    self.mag_short[star.index] = -2.5 * np.log10(star.flux1 / ref_flux[0]) + ref_mag_UBV[0]
-                    self.mag_long[star.index] = -2.5 * np.log10(star.flux2 / ref_flux[1]) + ref_mag_UBV[1]
-                else:
-                    self.mag_short[star.index] = None
-                    self.mag_long[star.index] = None
 
-        colour_index = self.mag_short - self.mag_long
-        colour_index_0 = colour_index - reddening
+    def set_reddening(self, reddening: float):
+        self.reddening = reddening
+        self.update_positions()
+
+
+    def set_combination(self, attribute: str, band: int):
+        """Chooses the bands of colour index or magnitude axis"""
+        setattr(self, attribute, band)
+        self.update_selection(np.arange(len(self.star_field)))
+        self.update_positions()
+
+
+    def update_positions(self):
+        """All points move, so axes are rescaled and the whole figure is redrawn"""
+
+        names = self.star_field.band_names
+        arbitrary_unit_mag = not all(np.any(self.ref_mask[band]) for band in (self.colour_a, self.colour_b, self.mag_band))
 
         ex = "[mag]" if not arbitrary_unit_mag else "[a.u.]"
-        ax.set_xlabel(f"Colour Index ({input_cmd['short_colour']}-{input_cmd['long_colour']}) {ex}")
-        ax.set_ylabel(f"{input_cmd['long_colour']} {ex}")
+        self.ax.set_xlabel(f"Colour Index ({names[self.colour_a]}-{names[self.colour_b]}) {ex}")
+        self.ax.set_ylabel(f"{names[self.mag_band]} {ex}")
+
+        colour_index = self.mags[self.colour_a] - self.mags[self.colour_b]
+        colour_index_0 = colour_index - self.reddening
+        offsets = np.c_[colour_index_0, self.mags[self.mag_band]]
+
+        self.points.set_offsets(offsets)
+        self.rescale()
+
+        self.figure_canvas.draw_idle()
+
+
+    def rescale(self) -> bool:
+        """Fits the axes to the selected stars. Returns True if the limits changed"""
+
+        offsets = np.asarray(self.points.get_offsets())
+        selected = (self.star_field.status & StarStatus.Selected) != 0
+        visible = offsets[selected & np.all(np.isfinite(offsets), axis=1)]
+
+        if not len(visible):
+            return False
+
+        limits = (self.ax.get_xlim(), self.ax.get_ylim())
 
-        for star in filter(lambda x: StarStatus.Selected in x.status, stars):
-            ax.plot(colour_index_0[star.index], self.mag_long[star.index], 'bo')
+        self.ax.ignore_existing_data_limits = True
+        self.ax.update_datalim(visible)
+        self.ax.autoscale_view()
 
-        ax.invert_yaxis()
+        return limits != (self.ax.get_xlim(), self.ax.get_ylim())
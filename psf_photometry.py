@@ -0,0 +1,107 @@
+import numpy as np
+from astropy.table import QTable
+from photutils.psf import CircularGaussianPRF, PSFPhotometry, SourceGrouper
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+
+class Tile(NamedTuple):
+    band: int
+    core: tuple[slice, slice]       # stars with their centre in here are measured by this tile
+    padded: tuple[slice, slice]     # core plus margin, the part of the image that is fitted
+    stars: np.ndarray               # indices of stars inside padded
+    measured: np.ndarray            # mask of stars which lie in core
+
+
+def make_tiles(band: int, shape: tuple[int, int], positions: np.ndarray, tile_size: int, margin: int) -> list[Tile]:
+    """Splits the image into tiles of tile_size, each fitted with a margin around it.
+    Stars in the margin are fitted together with the stars of the core, so light of
+    neighbours across the tile border is modelled, but only core stars are kept"""
+
+    height, width = shape
+    x, y = positions.T
+    tiles = []
+
+    for top in range(0, height, tile_size):
+        for left in range(0, width, tile_size):
+            bottom, right = min(top + tile_size, height), min(left + tile_size, width)
+
+            in_core = (x >= left - 0.5) & (x < right - 0.5) & (y >= top - 0.5) & (y < bottom - 0.5)
+            if not np.any(in_core):
+                continue
+
+            padded = (slice(max(top - margin, 0), min(bottom + margin, height)),
+                      slice(max(left - margin, 0), min(right + margin, width)))
+
+            in_padded = ((x >= padded[1].start - 0.5) & (x < padded[1].stop - 0.5)
+                         & (y >= padded[0].start - 0.5) & (y < padded[0].stop - 0.5))
+            stars = np.flatnonzero(in_padded)
+
+            tiles.append(Tile(band, (slice(top, bottom), slice(left, right)), padded, stars, in_core[stars]))
+
+    return tiles
+
+
+def fit_tile(data: np.ndarray, xy: np.ndarray, FWHM: float, aperture_radius: float) -> np.ndarray:
+    """Fits all stars of one (background subtracted) tile at once, overlapping stars are grouped
+    and fitted simultaneously. Positions may move by one pixel. Returns the fitted fluxes"""
+
+    psf_model = CircularGaussianPRF(fwhm=FWHM)
+    psf_model.fwhm.fixed = True
+
+    # odd fitting box of about +- FWHM around each star
+    fit_size = 2 * int(np.ceil(FWHM)) + 1
+
+    photometry = PSFPhotometry(psf_model, (fit_size, fit_size),
+                               grouper=SourceGrouper(min_separation=2.5 * FWHM),
+                               aperture_radius=aperture_radius, xy_bounds=1.0)
+
+    result = photometry(data, init_params=QTable({"x": xy[:, 0], "y": xy[:, 1]}))
+
+    return np.asarray(result["flux_fit"], dtype=np.float64)
+
+
+def _fit(args):
+    return fit_tile(*args)
+
+
+def psf_photometry(images: np.ndarray, positions: np.ndarray, FWHM: float, aperture_radius: float,
+                   tile_size: int = 512, n_workers: int = 0) -> np.ndarray:
+    """PSF fluxes of all stars in all (background subtracted) images, shape (n_images, n_stars).
+    Tiles of all images are independent and fitted in parallel worker processes"""
+
+    n_images, n_stars = positions.shape[:2]
+
+    # light of a star reaching into the core from outside, plus the fitting box of stars at the core border
+    margin = int(np.ceil(4 * FWHM))
+
+    tiles = [tile for i in range(n_images)
+             for tile in make_tiles(i, images[i].shape, positions[i], tile_size, margin)]
+
+    # only the padded part of the image is sent to the worker
+    tasks = [
+        (images[t.band][t.padded],
+         positions[t.band, t.stars] - (t.padded[1].start, t.padded[0].start),
+         FWHM, aperture_radius)
+        for t in tiles
+    ]
+
+    n_workers = min(n_workers or os.cpu_count() or 1, len(tasks))
+
+    if n_workers > 1:
+        # spawn: forking a process running Qt (and its threads) is not safe
+        with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            fluxes = list(executor.map(_fit, tasks))
+    else:
+        fluxes = [_fit(task) for task in tasks]
+
+    stars_flux = np.full((n_images, n_stars), np.nan)
+
+    # every star lies in exactly one core
+    for tile, flux in zip(tiles, fluxes):
+        stars_flux[tile.band, tile.stars[tile.measured]] = flux[tile.measured]
+
+    return stars_flux
@@ -0,0 +1,161 @@
+from PySide6.QtWidgets import QGraphicsObject, QGraphicsSceneHoverEvent
+from PySide6.QtGui import QPen, QPainter, QPainterPath
+from PySide6.QtCore import QRectF, QPointF, Signal
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from enum import IntFlag
+
+
+class StarStatus(IntFlag):
+    Deselected = 0b00
+    Selected = 0b01
+    Labeled = 0b10
+
+
+class Pens:
+    """Used to color ellipse around stars depending on its status"""
+
+    Deselected = QPen("red")
+    Selected = QPen("green")
+    DeselectedLabeled = QPen("orange")
+    SelectedLabeled = QPen("blue")
+
+    @staticmethod
+    def from_status(star_status: StarStatus) -> QPen:
+        return [Pens.Deselected, Pens.Selected,
+                Pens.DeselectedLabeled, Pens.SelectedLabeled][star_status]
+
+
+class StarField(QGraphicsObject):
+    """Single graphics item holding all stars of the image.
+    Markers are drawn as one cached path per status, so changing the status of
+    any number of stars costs exactly one repaint. Per-star data is kept in arrays
+    indexed by star index, hit-testing uses a KD-tree of the positions"""
+
+    # Signals are emitted with the indices of all changed stars
+    status_changed = Signal(np.ndarray)
+    labels_changed = Signal(np.ndarray)
+
+    def __init__(self, positions: np.ndarray, radius: float, band_names: tuple[str, ...], *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        n_stars = len(positions)
+
+        self.positions = np.asarray(positions, dtype=np.float64)
+        self.radius = radius
+        self.band_names = band_names
+
+        n_bands = len(band_names)
+
+        self.status = np.full(n_stars, StarStatus.Selected, dtype=int)
+        # user defined magnitudes per band, 0 if not labeled (in that band)
+        self.vmag = np.zeros((n_bands, n_stars))
+        self.flux = np.zeros((n_bands, n_stars))
+        # False if the star is below snr_min in that band (only possible with forced photometry)
+        self.detected = np.ones((n_bands, n_stars), dtype=bool)
+
+        self.tree = cKDTree(self.positions) if n_stars else None
+        self.paths = None
+
+        if n_stars:
+            low = self.positions.min(axis=0) - radius - 1
+            high = self.positions.max(axis=0) + radius + 1
+            self.bounds = QRectF(QPointF(*low), QPointF(*high))
+        else:
+            self.bounds = QRectF()
+
+        self.setAcceptHoverEvents(True)
+
+
+    def __len__(self):
+        return len(self.positions)
+
+
+    def boundingRect(self) -> QRectF:
+        return self.bounds
+
+
+    def paint(self, painter: QPainter, option, widget=None):
+        if self.paths is None:
+            self.paths = {}
+            d = 2 * self.radius
+
+            for status in map(StarStatus, np.unique(self.status).tolist()):
+                path = QPainterPath()
+                for x, y in self.positions[self.status == status] - self.radius:
+                    path.addEllipse(x, y, d, d)
+                self.paths[status] = path
+
+        for status, path in self.paths.items():
+            painter.setPen(Pens.from_status(status))
+            painter.drawPath(path)
+
+
+    def invalidate(self):
+        """Rebuild the marker paths on next paint"""
+        self.paths = None
+        self.update()
+
+
+    def star_at(self, pos: QPointF) -> int | None:
+        """Returns the index of the star whose marker contains pos or None"""
+        if self.tree is None:
+            return None
+
+        distance, index = self.tree.query((pos.x(), pos.y()), distance_upper_bound=self.radius)
+        return int(index) if np.isfinite(distance) else None
+
+
+    def stars_in(self, rect: QRectF) -> np.ndarray:
+        """Returns indices of all stars whose centre lies in rect"""
+        if self.tree is None:
+            return np.empty(0, dtype=int)
+
+        center = rect.center()
+        candidates = np.asarray(self.tree.query_ball_point(
+            (center.x(), center.y()), np.hypot(rect.width(), rect.height()) / 2), dtype=int)
+
+        x, y = self.positions[candidates].T
+        inside = (x >= rect.left()) & (x <= rect.right()) & (y >= rect.top()) & (y <= rect.bottom())
+        return candidates[inside]
+
+
+    def toggle(self, indices: np.ndarray | slice):
+        """Toggles selection of all stars in indices"""
+        indices = np.arange(len(self))[indices]
+
+        self.status[indices] ^= StarStatus.Selected
+        self.invalidate()
+        self.status_changed.emit(indices)
+
+
+    def label(self, indices: np.ndarray, vmag: np.ndarray):
+        """Sets user defined magnitudes (shape (n_bands, len(indices))). Stars with all values 0 are set back to standard"""
+
+        indices = np.atleast_1d(indices)
+        vmag = np.reshape(vmag, (len(self.band_names), len(indices)))
+
+        self.vmag[:, indices] = vmag
+
+        labeled = np.any(vmag != 0.0, axis=0)
+        self.status[indices] = np.where(labeled,
+                                        self.status[indices] | StarStatus.Labeled,
+                                        self.status[indices] & ~StarStatus.Labeled)
+        self.invalidate()
+        self.labels_changed.emit(indices)
+
+
+    def hoverMoveEvent(self, event: QGraphicsSceneHoverEvent):
+        """Shows user defined magnitudes of labeled stars as tooltip"""
+
+        index = self.star_at(event.pos())
+
+        if index is not None and self.status[index] & StarStatus.Labeled:
+            self.setToolTip(" | ".join(
+                f"{name}: {mag}" for name, mag in zip(self.band_names, self.vmag[:, index])))
+        else:
+            self.setToolTip("")
+
+        super().hoverMoveEvent(event)
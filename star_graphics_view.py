@@ -2,33 +2,29 @@ from PySide6.QtWidgets import QGraphicsView
 from PySide6.QtGui import QMouseEvent, QWheelEvent
 from PySide6.QtCore import Qt, QPoint, Signal
 
-from star_ellipse import StarStatus, StarEllipse
+from star_field import StarField
 
 
 class StarGraphicsView(QGraphicsView):
     """Display class showing converted fits file as star-image
     Provides framework for Mouse-interactions"""
 
-    # Signal emitted when parameters of a star should be set
-    star_chosen = Signal(StarEllipse)
+    # Signal emitted with the star index when parameters of a star should be set
+    star_chosen = Signal(int)
 
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+        # Set by MainWindow once stars are detected
+        self.star_field: StarField | None = None
 
-    def stars(self):
-        """Returns all StarEllipse instances in the currently held scene
-        Should be used, as the starmap (pixmap) is also one item of self.scene"""
 
-        return filter(lambda x: isinstance(x, StarEllipse), self.scene().items())
-
-
-    def get_star_at(self, pos: QPoint) -> StarEllipse | None:
-        """Returns the StarEllipse instance at position pos or None"""
-        if (star := self.itemAt(pos)) and isinstance(star, StarEllipse):
-            return star
-        return None
+    def get_star_at(self, pos: QPoint) -> int | None:
+        """Returns the index of the star at view position pos or None"""
+        if self.star_field is None:
+            return None
+        return self.star_field.star_at(self.mapToScene(pos))
 
 
     def mousePressEvent(self, event: QMouseEvent):
@@ -51,7 +47,7 @@ class StarGraphicsView(QGraphicsView):
 
             # Signal MainWindow that we would like to set parameters for this particular star
             case Qt.MouseButton.RightButton:
-                if star := self.get_star_at(event.pos()):
+                if (star := self.get_star_at(event.pos())) is not None:
                     self.star_chosen.emit(star)
 
             case _:
@@ -62,10 +58,10 @@ class StarGraphicsView(QGraphicsView):
 
     def mouseReleaseEvent(self, event: QMouseEvent):
         # Select stars with rubber band
-        if event.button() == Qt.MouseButton.LeftButton and self.dragMode() == QGraphicsView.DragMode.RubberBandDrag:
-            select_rect = self.mapToScene(self.rubberBandRect())
-            for star in filter(lambda x: isinstance(x, StarEllipse), self.scene().items(select_rect)):
-                star.status ^= StarStatus.Selected
+        if (event.button() == Qt.MouseButton.LeftButton and self.dragMode() == QGraphicsView.DragMode.RubberBandDrag
+                and self.star_field is not None):
+            select_rect = self.mapToScene(self.rubberBandRect()).boundingRect()
+            self.star_field.toggle(self.star_field.stars_in(select_rect))
 
         self.setDragMode(QGraphicsView.DragMode.NoDrag)
         super().mouseReleaseEvent(event)
@@ -78,6 +74,6 @@ class StarGraphicsView(QGraphicsView):
 
 
     def toggle_selection(self, pos: QPoint):
-        """Toggles selection of a star. star.status is a property, handling everything concerning graphics etc."""
-        if star := self.get_star_at(pos):
-            star.status ^= StarStatus.Selected
+        """Toggles selection of a star. StarField handles everything concerning graphics etc."""
+        if (star := self.get_star_at(pos)) is not None:
+            self.star_field.toggle([star])
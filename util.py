@@ -100,17 +100,7 @@ def detect_star(n_stars_min, scidata, median, std, FWHM, ratio_gauss, factor_thr
             list_star_new = np.r_[list_star_new, np.array([[list_stars[i_star, 0], list_stars[i_star, 1]]])]
 
     if len(list_star_new) < n_stars_min:
-        print('')
-        print(
-            '##########################################################################################################################')
-        print(
-            'Not enough stars detected (%i). Please reduce the minimum number of stars or check input parameters like FWHM or threshold.' % len(
-                list_star_new))
-        print('Another possibility is that some of your images are bad and you have to remove them from the stack.')
-        print(
-            '##########################################################################################################################')
-        print('')
-        exit()
+        not_enough_stars(len(list_star_new))
     else:
         n_stars_min = len(list_star_new)
 
@@ -128,6 +118,162 @@ def detect_star(n_stars_min, scidata, median, std, FWHM, ratio_gauss, factor_thr
     return sources, n_stars_min, positions
 
 
+def not_enough_stars(n_stars):
+    print('')
+    print(
+        '##########################################################################################################################')
+    print(
+        'Not enough stars detected (%i). Please reduce the minimum number of stars or check input parameters like FWHM or threshold.' % n_stars)
+    print('Another possibility is that some of your images are bad and you have to remove them from the stack.')
+    print(
+        '##########################################################################################################################')
+    print('')
+    exit()
+
+
+def detect_star_combined(n_stars_min, scidata, median, std, FWHM, ratio_gauss, factor_threshold, peakmax=48000):
+    """Runs DAOStarFinder once on the sum of all (aligned) frames. Positions are the same in every frame,
+    so fluxes can be measured at those fixed positions (forced photometry) even where a star is faint in one band.
+    Returns the same as detect_star, sources holds only the stars of positions (saturated ones removed)"""
+
+    n_fits = scidata.shape[0]
+
+    # background subtracted deep image, noise of uncorrelated frames adds in quadrature
+    combined = np.sum(scidata - np.reshape(median, (n_fits, 1, 1)), axis=0)
+    std_combined = np.sqrt(np.sum(np.square(std)))
+
+    mask = np.ones(combined.shape, dtype=bool)
+    mask[10:-10, 10:-10] = False
+    daofind = DAOStarFinder(threshold=factor_threshold * std_combined, fwhm=FWHM, ratio=ratio_gauss, exclude_border=True)
+    sources = daofind(combined, mask=mask)
+
+    if sources is None or len(sources) < n_stars_min:
+        not_enough_stars(0 if sources is None else len(sources))
+
+    sources.sort(['peak'])
+    sources.reverse()
+
+    # saturation has to be checked per frame, the summed image may exceed peakmax anyway.
+    # Like peakmax of DAOStarFinder in detect_star: highest background subtracted pixel around the star
+    r = max(1, int(np.ceil(FWHM)))
+    dy, dx = np.mgrid[-r:r + 1, -r:r + 1]
+    ix = np.clip(np.rint(np.asarray(sources['xcentroid'])).astype(int)[:, None, None] + dx, 0, combined.shape[1] - 1)
+    iy = np.clip(np.rint(np.asarray(sources['ycentroid'])).astype(int)[:, None, None] + dy, 0, combined.shape[0] - 1)
+
+    peak = np.max(scidata[:, iy, ix] - np.reshape(median, (n_fits, 1, 1, 1)), axis=(2, 3))
+    sources = sources[np.all(peak < peakmax, axis=0)]
+
+    if len(sources) < n_stars_min:
+        not_enough_stars(len(sources))
+
+    xy = np.c_[sources['xcentroid'], sources['ycentroid']]
+    positions = np.repeat(xy[np.newaxis, :, :], n_fits, axis=0)
+
+    return [sources], len(xy), positions
+
+
+def detection_flags(stars_flux, std, r_aperture, snr_min):
+    """Per frame and star: is the aperture flux at least snr_min times the background noise inside the aperture?"""
+
+    noise = np.reshape(std, (-1, 1)) * np.sqrt(np.pi) * r_aperture
+    return stars_flux >= snr_min * noise
+
+
+def bin_frame(data: np.ndarray, binning: int) -> np.ndarray:
+    """Block mean over binning x binning pixels, incomplete blocks at the border are cut off"""
+
+    if binning <= 1:
+        return data
+
+    ny, nx = data.shape[0] // binning, data.shape[1] // binning
+    return data[:ny * binning, :nx * binning].reshape(ny, binning, nx, binning).mean(axis=(1, 3))
+
+
+def frame_quality(data, FWHM, ratio_gauss, factor_threshold, binning=2, n_fwhm_stars=50):
+    """Cheap quality metrics of one light frame, measured on the binned frame:
+    background level, background noise, number of stars and median FWHM (in unbinned pixels)"""
+
+    binned = bin_frame(np.asarray(data, dtype=np.float64), binning)
+    _, median, std = sigma_clipped_stats(binned, sigma=3.0)
+
+    # binning also reduces the noise, so the same threshold factor finds comparable stars
+    daofind = DAOStarFinder(threshold=factor_threshold * std, fwhm=max(FWHM / binning, 1.0), ratio=ratio_gauss, exclude_border=True)
+    sources = daofind(binned - median)
+
+    if sources is None or len(sources) == 0:
+        return median, std, 0, np.nan
+
+    n_stars = len(sources)
+
+    sources.sort(['peak'])
+    sources.reverse()
+    sources = sources[:n_fwhm_stars]
+
+    # second moments in 5x5 cutouts around the brightest stars
+    r = 2
+    cx = np.rint(np.asarray(sources['xcentroid'])).astype(int)
+    cy = np.rint(np.asarray(sources['ycentroid'])).astype(int)
+    inside = (cx >= r) & (cx < binned.shape[1] - r) & (cy >= r) & (cy < binned.shape[0] - r)
+    cx, cy = cx[inside], cy[inside]
+
+    dy, dx = np.mgrid[-r:r + 1, -r:r + 1]
+    cutouts = np.maximum(binned[cy[:, None, None] + dy, cx[:, None, None] + dx] - median, 0)
+    weight = np.maximum(cutouts.sum(axis=(1, 2)), 1e-12)
+
+    mx = (cutouts * dx).sum(axis=(1, 2)) / weight
+    my = (cutouts * dy).sum(axis=(1, 2)) / weight
+    var = (cutouts * ((dx - mx[:, None, None]) ** 2 + (dy - my[:, None, None]) ** 2)).sum(axis=(1, 2)) / weight / 2
+
+    # back to unbinned pixels, remove the variance added by the binning itself
+    sigma = np.sqrt(np.maximum(var * binning ** 2 - binning ** 2 / 12, 0))
+    fwhm = 2 * np.sqrt(2 * np.log(2)) * np.median(sigma) if len(sigma) else np.nan
+
+    return median, std, n_stars, fwhm
+
+
+def reject_frames(metrics, min_star_fraction, max_fwhm_factor, max_noise_factor, max_background_sigma):
+    """Compares every frame to the median frame of the same band.
+    metrics has one row (background, noise, n_stars, fwhm) per frame.
+    Returns a boolean array of frames to keep and a list of reasons per frame.
+    At least one frame is always kept: if all frames fail, the one with most stars among
+    the frames failing the fewest tests is kept (its reasons are still returned)"""
+
+    metrics = np.asarray(metrics, dtype=np.float64)
+    background, noise, n_stars, fwhm = metrics.T
+
+    median_background = np.median(background)
+    median_noise = np.median(noise)
+    median_stars = np.median(n_stars)
+    median_fwhm = np.nanmedian(fwhm) if np.any(np.isfinite(fwhm)) else np.nan
+
+    reasons = [[] for _ in range(len(metrics))]
+
+    for i in np.flatnonzero(n_stars < min_star_fraction * median_stars):
+        reasons[i].append(f"{n_stars[i]:.0f} stars (median {median_stars:.0f})")
+
+    for i in np.flatnonzero(~(fwhm <= max_fwhm_factor * median_fwhm) & np.isfinite(median_fwhm)):
+        reasons[i].append(f"FWHM {fwhm[i]:.2f} px (median {median_fwhm:.2f} px)")
+
+    for i in np.flatnonzero(noise > max_noise_factor * median_noise):
+        reasons[i].append(f"noise {noise[i]:.1f} (median {median_noise:.1f})")
+
+    # the sky level drifts through a night (moon, twilight), so the background is compared to the
+    # scatter of the frame backgrounds (MAD), not to the pixel noise; the noise is only a lower limit
+    background_scatter = max(1.4826 * np.median(np.abs(background - median_background)), median_noise)
+
+    for i in np.flatnonzero(np.abs(background - median_background) > max_background_sigma * background_scatter):
+        reasons[i].append(f"background {background[i]:.1f} (median {median_background:.1f})")
+
+    keep = np.array([not r for r in reasons], dtype=bool)
+
+    if not np.any(keep):
+        n_reasons = np.array([len(r) for r in reasons])
+        candidates = np.flatnonzero(n_reasons == n_reasons.min())
+        keep[candidates[np.argmax(n_stars[candidates])]] = True
+
+    return keep, reasons
+
+
 # for alignment of the stars -> offset
 def get_offset(scidata, median, std, reference_fit=0):
     n_fits = scidata.shape[0]
@@ -151,6 +297,19 @@ def get_offset(scidata, median, std, reference_fit=0):
     return offset
 
 
+def shift_data(data, n_len, offset, pixel):
+    """Shifts the first n_len frames of data in place by offset, uncovered pixels are set to 0"""
+
+    for i in range(n_len):
+        upper0 = abs(max(0, offset[i, 0]))
+        lower0 = abs(min(0, offset[i, 0]))
+        upper1 = abs(max(0, offset[i, 1]))
+        lower1 = abs(min(0, offset[i, 1]))
+        tmp = np.pad(data[i], ((upper0, lower0), (upper1, lower1)), mode='constant')
+        data[i] = tmp[lower0 : pixel[0] + lower0,
+                      lower1 : pixel[1] + lower1]
+
+
 def get_stats(scidata):
     if scidata.ndim == 3:
         n_fits = scidata.shape[0]